@@ -1,5 +1,8 @@
 __author__ = 'eirikvageskar'
 
+import collections
+import itertools
+
 import numpy as np
 
 
@@ -37,7 +40,40 @@ def backward(t, o, b):
     return t*o*b
 
 
-def forward_with_observations(t, obs_dict, f, observations):
+def forward_scaled(t, o, f):
+    """Computes one HMM forward step like forward, but also returns the normalizing constant, which is
+    P(observation | earlier observations) when f is normalized.
+
+    :param t: Transition model
+    :param o: An observation matrix for the transition model
+    :param f: The last forward value
+    :return: The forward value and the scale factor
+    """
+
+    temp = np.dot(np.dot(o, t.transpose()), f)
+    scale = float(temp.sum())
+    return temp/scale, scale
+
+
+def backward_scaled(t, o, b, scale=None):
+    """Computes one HMM backward step like backward, divided by a scale factor so that b does not underflow. With the
+    scale factor of the forward step for the same observation, forward and backward values stay in proportion as in
+    the unscaled algorithm; without one, b is normalized.
+
+    :param t: Transition model
+    :param o: An observation matrix for the transition model
+    :param b: The last backward value
+    :param scale: The scale factor, or None to normalize
+    :return: The backward value and the scale factor used
+    """
+
+    temp = np.dot(np.dot(t, o), b)
+    if scale is None:
+        scale = float(temp.sum())
+    return temp/scale, scale
+
+
+def forward_with_observations(t, obs_dict, f, observations, return_log_likelihood=False):
     """Uses a list of observations along with a dictionary containing the observation values for given evidence to
     compute a forward value.
 
@@ -45,14 +81,20 @@ def forward_with_observations(t, obs_dict, f, observations):
     :param obs_dict: A dictionary of observation matrices for different observation values
     :param f: First f-value
     :param observations: The observations
-    :return: The last f-value
+    :param return_log_likelihood: Whether to also return the log-likelihood of the observations
+    :return: The last f-value (and the log-likelihood)
     """
 
+    log_likelihood = 0.0
+
     for i in range(len(observations)):
-        f = forward(t, obs_dict[observations[i]], f)
+        f, scale = forward_scaled(t, obs_dict[observations[i]], f)
+        log_likelihood += np.log(scale)
         if show_normalized:
             print '\nf1:' + str(i+1) + '\n', f
 
+    if return_log_likelihood:
+        return f, log_likelihood
     return f
 
 
@@ -68,25 +110,470 @@ def forward_backward(t, obs_dict, f, observations):
     """
 
     fv = [f]
+    scales = []  # scales[i] is the normalizing constant of the forward step for observations[i]
 
     for i in range(len(observations)):
-        fv.append(forward(t, obs_dict[observations[i]], fv[i]))
+        f, scale = forward_scaled(t, obs_dict[observations[i]], fv[i])
+        fv.append(f)
+        scales.append(scale)
 
-    sv = [np.matrix('1; 1')]*(len(fv)-1)
+    sv = [None]*(len(fv)-1)
 
-    b = np.matrix('1; 1')
+    b = np.matrix(np.ones(np.shape(fv[0])))
 
     for i in range(len(sv)):
         j = -(i+1)
         sv[j] = normalize(np.multiply(fv[j], b))
 
-        b = backward(t, obs_dict[observations[j]], b)
+        # Dividing by the forward step's scale factor keeps b from underflowing on long sequences
+        b, _ = backward_scaled(t, obs_dict[observations[j]], b, scales[j])
         if show_backward:
             print '\nb' + str(len(sv)-i) + ':' + str(len(sv)) + '\n', b
 
     return sv
 
 
+def observation_probabilities(o):
+    """Turns an observation matrix into the vector of its diagonal, the probability of the observation in each state.
+
+    :param o: An observation matrix (diagonal), or already a vector
+    :return: A 1-D array
+    """
+    o = np.asarray(o, dtype=float)
+    return np.diag(o).copy() if o.ndim == 2 else o.ravel()
+
+
+def observation_operators(t, obs_dict, backward=True):
+    """Precomputes, once per observation value, the matrices of a forward step (O*T') and of a backward step (T*O).
+
+    :param t: Transition model
+    :param obs_dict: A dictionary of observation matrices for different observation values
+    :param backward: Whether to compute the backward matrices too
+    :return: A dictionary numbering the observation values, and (values x N x N) arrays of forward and backward
+        matrices in that numbering (None for the backward ones if not computed)
+    """
+    t = np.asarray(t, dtype=float)
+    symbols = dict((value, k) for k, value in enumerate(obs_dict))
+
+    forward_ops = np.empty((len(symbols), len(t), len(t)))
+    backward_ops = np.empty((len(symbols), len(t), len(t))) if backward else None
+    for value, k in symbols.items():
+        o = observation_probabilities(obs_dict[value])
+        forward_ops[k] = o[:, np.newaxis] * t.T
+        if backward:
+            backward_ops[k] = t * o[np.newaxis, :]
+
+    return symbols, forward_ops, backward_ops
+
+
+SCAN_MAX_STATES = 8  # Models with at most this many states compute their messages with prefix products
+SCAN_BLOCK = 2048  # Time steps per block of prefix products
+
+
+def prefix_products(matrices):
+    """Inclusive prefix products of a stack of matrices, p[k] = m[k]*...*m[0], each scaled to sum to 1. Computed
+    with log2(K) batched products (a Hillis-Steele scan) instead of K single ones.
+
+    :param matrices: A (K x N x N) array
+    :return: A (K x N x N) array of scaled products
+    """
+    p = matrices.copy()
+    k = 1
+    while k < len(p):
+        p[k:] = np.matmul(p[k:], p[:-k])
+        p[k:] /= p[k:].sum(axis=(1, 2), keepdims=True)
+        k *= 2
+
+    return p
+
+
+def chain_messages(ops, codes, start, out):
+    """Computes a chain of normalized messages, out[i] = normalize(ops[codes[i]]*out[i-1]) with out[-1] = start, as
+    forward (and, reversed, backward) messages are. Small models do it a block at a time with prefix_products, larger
+    ones one step at a time, where the matrix product outweighs the cost of the loop.
+
+    :param ops: A (values x N x N) array of step matrices
+    :param codes: Array with the number of the matrix of every step
+    :param start: The message before the first step
+    :param out: A (len(codes) x N) array for the messages
+    :return: out
+    """
+    start = np.asarray(start, dtype=float).ravel()
+
+    if ops.shape[1] > SCAN_MAX_STATES:
+        for i in range(len(codes)):
+            out[i] = np.dot(ops[codes[i]], start)
+            out[i] /= out[i].sum()
+            start = out[i]
+        return out
+
+    for begin in range(0, len(codes), SCAN_BLOCK):
+        block = out[begin:begin + SCAN_BLOCK]
+        block[...] = np.dot(prefix_products(ops[codes[begin:begin + SCAN_BLOCK]]), start)
+        block /= block.sum(axis=1, keepdims=True)
+        start = block[-1]
+
+    return out
+
+
+def step_scales(ops, codes, start, messages):
+    """The normalizing constants of a chain of messages from chain_messages, for all steps at once: the sum of
+    ops[codes[i]]*messages[i-1] is the dot product of the column sums of ops[codes[i]] with messages[i-1].
+
+    :param ops: A (values x N x N) array of step matrices
+    :param codes: Array with the number of the matrix of every step
+    :param start: The (normalized) message before the first step
+    :param messages: The normalized messages
+    :return: Array with the scale factor of every step
+    """
+    previous = np.vstack([np.asarray(start, dtype=float).ravel(), messages[:-1]])
+
+    return (ops.sum(axis=1)[codes] * previous[:len(codes)]).sum(axis=1)
+
+
+def forward_with_log_likelihood(t, obs_dict, f, observations):
+    """Filters a stream of observations, of any length, and scores it: returns the last f-value and the log-likelihood
+    of all observations, the sum of the logs of the scale factors of the forward steps. The observations are read a
+    block at a time, so they can come from a generator, and memory does not grow with the stream.
+
+    :param t: Transition model
+    :param obs_dict: A dictionary of observation matrices (or vectors) for different observation values
+    :param f: First f-value
+    :param observations: An iterable of observations
+    :return: The last f-value, as a 1-D array, and the log-likelihood
+    """
+    symbols, forward_ops, _ = observation_operators(t, obs_dict, backward=False)
+
+    f = np.asarray(f, dtype=float).ravel()
+    f = f / f.sum()
+    log_likelihood = 0.0
+    messages = np.empty((SCAN_BLOCK, len(f)))
+
+    observations = iter(observations)
+    while True:
+        codes = np.array([symbols[observation] for observation in itertools.islice(observations, SCAN_BLOCK)],
+                         dtype=np.intp)
+        if len(codes) == 0:
+            return f, log_likelihood
+
+        block = chain_messages(forward_ops, codes, f, messages[:len(codes)])
+        log_likelihood += float(np.log(step_scales(forward_ops, codes, f, block)).sum())
+        f = block[-1].copy()
+
+
+def _forward_backward_checkpointed(forward_ops, backward_ops, codes, f, segment, out):
+    """The checkpointed sweep of forward_backward_array: the forward pass keeps only the f-value before every
+    segment of the sequence, and the backward pass recomputes each segment's forward messages from its checkpoint, in
+    one (segment x N) buffer, just before smoothing it.
+
+    :param forward_ops: A (values x N x N) array of forward matrices
+    :param backward_ops: A (values x N x N) array of backward matrices
+    :param codes: Array with the observation number of every time step
+    :param f: The normalized first f-value
+    :param segment: Time steps per segment
+    :param out: A (T x N) array for the smoothed values
+    :return: The log-likelihood of the observations
+    """
+    starts = range(0, len(codes), segment)
+    checkpoints = np.empty((len(starts), len(f)))
+    messages = np.empty((segment, len(f)))
+    log_likelihood = 0.0
+
+    for k, begin in enumerate(starts):
+        checkpoints[k] = f
+        block_codes = codes[begin:begin + segment]
+        block = chain_messages(forward_ops, block_codes, f, messages[:len(block_codes)])
+        log_likelihood += float(np.log(step_scales(forward_ops, block_codes, f, block)).sum())
+        f = block[-1].copy()
+
+    b = np.full(len(f), 1.0 / len(f))  # The b-value of the last time step
+    for k in reversed(range(len(starts))):
+        begin = starts[k]
+        block_codes = codes[begin:begin + segment]
+        v = chain_messages(forward_ops, block_codes, checkpoints[k], out[begin:begin + len(block_codes)])
+
+        block = messages[:len(block_codes)]
+        block[-1] = b
+        chain_messages(backward_ops, block_codes[:0:-1], b, block[-2::-1])
+
+        v *= block
+        v /= v.sum(axis=1, keepdims=True)
+
+        b = np.dot(backward_ops[block_codes[0]], block[0])
+        b /= b.sum()
+
+    return log_likelihood
+
+
+def forward_backward_array(t, obs_dict, f, observations, return_log_likelihood=False, checkpoint=False):
+    """forward_backward for any number of states, on plain arrays. The forward and backward matrices of every
+    observation value are computed once, and all forward and backward messages are kept in two preallocated (T x N)
+    arrays (see chain_messages); the smoothed values are then their normalized product, in one step. b is normalized
+    at every step, which does not change the smoothed values but keeps it from underflowing on long sequences.
+
+    For very long sequences, checkpoint trades time for memory: only every sqrt(T)-th forward message is kept, and
+    the forward messages in between are computed again during the backward pass, a segment at a time. Besides the
+    result, this needs O(sqrt(T)*N) memory instead of two (T x N) arrays, for one more forward pass (about 1.5 times
+    the work).
+
+    :param t: Transition model (N x N)
+    :param obs_dict: A dictionary of observation matrices (or vectors) for different observation values
+    :param f: First f-value (N values)
+    :param observations: The observations
+    :param return_log_likelihood: Whether to also return the log-likelihood of the observations
+    :param checkpoint: False to keep all messages, True for checkpoints every sqrt(T) steps, or the number of steps
+        between checkpoints
+    :return: A (T x N) array; row i is the smoothed distribution of the state at time i+1 (and the log-likelihood)
+    """
+    symbols, forward_ops, backward_ops = observation_operators(t, obs_dict)
+    codes = np.array([symbols[observation] for observation in observations], dtype=np.intp)
+
+    f = np.asarray(f, dtype=float).ravel()
+    f = f / f.sum()
+
+    if checkpoint is not False and len(codes):
+        segment = int(np.ceil(np.sqrt(len(codes)))) if checkpoint is True else int(checkpoint)
+        if segment < 1:
+            raise ValueError('The number of steps between checkpoints must be at least 1')
+
+        v = np.empty((len(codes), len(f)))
+        log_likelihood = _forward_backward_checkpointed(forward_ops, backward_ops, codes, f, segment, v)
+        if return_log_likelihood:
+            return v, log_likelihood
+        return v
+
+    v = chain_messages(forward_ops, codes, f, np.empty((len(codes), len(forward_ops[0]))))
+    if return_log_likelihood:
+        log_likelihood = float(np.log(step_scales(forward_ops, codes, f, v)).sum())
+
+    # b[i] comes from the observations after time i+1; the last is all ones, and the rest chain backwards from it
+    b = np.empty_like(v)
+    if len(b):
+        b[-1] = 1.0 / v.shape[1]
+        chain_messages(backward_ops, codes[:0:-1], b[-1], b[-2::-1])
+
+    v *= b
+    v /= v.sum(axis=1, keepdims=True)
+
+    if return_log_likelihood:
+        return v, log_likelihood
+    return v
+
+
+def pack_sequences(sequences, symbols):
+    """Packs a ragged set of observation sequences into one padded array, longest first, so that the sequences still
+    running at any time step are a prefix of the batch.
+
+    :param sequences: A list of observation sequences
+    :param symbols: A dictionary numbering the observation values, as from observation_operators
+    :return: The order of the sequences in the batch, their lengths (descending) and a (B x longest) array of
+        observation numbers, padded with 0
+    """
+    order = np.array(sorted(range(len(sequences)), key=lambda k: -len(sequences[k])), dtype=np.intp)
+    lengths = np.array([len(sequences[k]) for k in order], dtype=np.intp)
+
+    codes = np.zeros((len(sequences), lengths[0] if len(lengths) else 0), dtype=np.intp)
+    for row, k in enumerate(order):
+        codes[row, :lengths[row]] = [symbols[observation] for observation in sequences[k]]
+
+    return order, lengths, codes
+
+
+def _active_counts(lengths, steps):
+    """The number of packed sequences still running at each time step."""
+    return np.searchsorted(-lengths, -np.arange(steps))
+
+
+def _forward_packed(forward_ops, codes, active, f, v=None):
+    """Runs the forward steps of packed sequences.
+
+    :param forward_ops: Forward matrices from observation_operators
+    :param codes: Packed observation numbers, from pack_sequences
+    :param active: Number of sequences running at each time step, from _active_counts
+    :param f: First f-value
+    :param v: Optional (B x longest x N) array to keep every f-value in
+    :return: The log-likelihood and the last f-value of each sequence, in batch order
+    """
+    f = np.asarray(f, dtype=float).ravel()
+    messages = np.tile(f / f.sum(), (len(codes), 1))
+    log_likelihoods = np.zeros(len(codes))
+
+    for i, k in enumerate(active):
+        step = np.matmul(forward_ops[codes[:k, i]], messages[:k, :, np.newaxis])[:, :, 0]
+        scale = step.sum(axis=1)
+        log_likelihoods[:k] += np.log(scale)
+        messages[:k] = step / scale[:, np.newaxis]
+        if v is not None:
+            v[:k, i] = messages[:k]
+
+    return log_likelihoods, messages
+
+
+def forward_batch(t, obs_dict, f, sequences):
+    """forward_with_observations for many independent sequences at once, one (B x N) step per time step. Also gives
+    the log-likelihood of every sequence, from the normalizing constants of its forward steps.
+
+    :param t: Transition model (N x N)
+    :param obs_dict: A dictionary of observation matrices (or vectors) for different observation values
+    :param f: First f-value (N values), shared by all sequences
+    :param sequences: A list of observation sequences, of any lengths
+    :return: An array with the log-likelihood of each sequence, and a (B x N) array with its last f-value
+    """
+    symbols, forward_ops, _ = observation_operators(t, obs_dict, backward=False)
+    order, lengths, codes = pack_sequences(sequences, symbols)
+
+    log_likelihoods, messages = _forward_packed(forward_ops, codes, _active_counts(lengths, codes.shape[1]), f)
+
+    # Back from batch order to the order of the sequences
+    unpacked = np.empty_like(order)
+    unpacked[order] = np.arange(len(order))
+
+    return log_likelihoods[unpacked], messages[unpacked]
+
+
+def forward_backward_batch(t, obs_dict, f, sequences):
+    """forward_backward for many independent sequences at once. The sequences are packed longest first (see
+    pack_sequences), so each time step is one (k x N) operation on the k sequences that are still running, and the
+    shorter ones need no masking.
+
+    :param t: Transition model (N x N)
+    :param obs_dict: A dictionary of observation matrices (or vectors) for different observation values
+    :param f: First f-value (N values), shared by all sequences
+    :param sequences: A list of observation sequences, of any lengths
+    :return: An array with the log-likelihood of each sequence, and a list with a (T x N) array of smoothed values
+        for each sequence, as from forward_backward_array
+    """
+    symbols, forward_ops, backward_ops = observation_operators(t, obs_dict)
+    order, lengths, codes = pack_sequences(sequences, symbols)
+    active = _active_counts(lengths, codes.shape[1])
+
+    v = np.zeros((len(sequences), codes.shape[1], forward_ops.shape[1]))
+    log_likelihoods, _ = _forward_packed(forward_ops, codes, active, f, v)
+
+    # A sequence's b stays all ones until the backward sweep reaches its last observation
+    b = np.ones((len(sequences), forward_ops.shape[1]))
+    for i in range(codes.shape[1] - 1, -1, -1):
+        k = active[i]
+        smoothed = v[:k, i] * b[:k]
+        v[:k, i] = smoothed / smoothed.sum(axis=1)[:, np.newaxis]
+
+        step = np.matmul(backward_ops[codes[:k, i]], b[:k, :, np.newaxis])[:, :, 0]
+        b[:k] = step / step.sum(axis=1)[:, np.newaxis]
+
+    posteriors = [None] * len(sequences)
+    for row, k in enumerate(order):
+        posteriors[k] = v[row, :lengths[row]]
+
+    unpacked = np.empty_like(order)
+    unpacked[order] = np.arange(len(order))
+
+    return log_likelihoods[unpacked], posteriors
+
+
+class FixedLagSmoother(object):
+    """Filters an endless stream of observations and smooths it with a fixed lag, as FIXED-LAG-SMOOTHING in fig. 15.6
+    of Artificial Intelligence: A Modern Approach (3rd edition), in constant memory and amortized constant time per
+    step.
+
+    After observation t, the smoother has the filtered value f_1:t and, once t > lag, the smoothed value of time
+    t-lag, f_1:t-lag times B*1, where B = T*O_t-lag+1*...*T*O_t. The last lag+1 forward values and the last lag
+    observations are kept in ring buffers (deques).
+
+    The book slides B along by multiplying with (T*O_t-lag)^-1 from the left, but that update multiplies rounding
+    errors by the condition number of T*O at every step, and fails when an observation has probability 0 in some
+    state. Here B is kept as two products instead (a two-stack queue): the newer observations in the window as one
+    running product, and the older ones as a stack of suffix products, so the oldest observation leaves by popping
+    the stack. When the stack runs empty, it is rebuilt from the running product's observations, which costs lag
+    products once every lag steps. All products are of non-negative matrices and are renormalized as they are made.
+    """
+
+    def __init__(self, t, obs_dict, f, lag):
+        """
+        :param t: Transition model (N x N)
+        :param obs_dict: A dictionary of observation matrices (or vectors) for different observation values
+        :param f: Prior (N values)
+        :param lag: Number of time steps the smoothed values lag behind
+        """
+        if lag < 0:
+            raise ValueError('The lag must be at least 0')
+
+        self.symbols, self.forward_ops, self.backward_ops = observation_operators(t, obs_dict)
+
+        self.lag = lag
+        self.time = 0
+        self.log_likelihood = 0.0
+
+        f = np.asarray(f, dtype=float).ravel()
+        self.forward_messages = collections.deque([f / f.sum()], maxlen=lag + 1)
+        self.evidence = collections.deque(maxlen=lag)
+
+        self.suffix_products = []  # For the older observations in the window; the last covers all of them
+        self.running_product = np.eye(len(f))  # For the newer observations in the window
+        self.running_count = 0
+
+    @property
+    def filtered(self):
+        """The filtered value of the current time, f_1:t."""
+        return self.forward_messages[-1]
+
+    def update(self, observation):
+        """Takes the next observation.
+
+        :param observation: An observation value
+        :return: The filtered value of the new time t, and the smoothed value of time t-lag (None while t <= lag)
+        """
+        code = self.symbols[observation]
+
+        f = np.dot(self.forward_ops[code], self.forward_messages[-1])
+        scale = f.sum()
+        self.log_likelihood += float(np.log(scale))
+        self.forward_messages.append(f / scale)  # Drops f_1:t-lag-1 when full
+        self.time += 1
+
+        if self.lag == 0:
+            return self.filtered, self.filtered
+
+        if len(self.evidence) == self.lag:  # The oldest observation leaves the window
+            if not self.suffix_products:
+                self._rebuild_suffix_products()
+            self.suffix_products.pop()
+        self.evidence.append(code)  # Drops the oldest observation when full
+
+        self.running_product = np.dot(self.running_product, self.backward_ops[code])
+        self.running_product /= self.running_product.sum()
+        self.running_count += 1
+
+        if self.time <= self.lag:
+            return self.filtered, None
+
+        b = self.running_product.sum(axis=1)
+        if self.suffix_products:
+            b = np.dot(self.suffix_products[-1], b)
+
+        smoothed = self.forward_messages[0] * b
+        return self.filtered, smoothed / smoothed.sum()
+
+    def _rebuild_suffix_products(self):
+        """Moves the observations of the running product to the stack of suffix products."""
+        product = np.eye(len(self.running_product))
+        for code in list(self.evidence)[-self.running_count:][::-1]:
+            product = np.dot(self.backward_ops[code], product)
+            product /= product.sum()
+            self.suffix_products.append(product)
+
+        self.running_product = np.eye(len(self.running_product))
+        self.running_count = 0
+
+    def run(self, observations):
+        """Takes observations from an iterable (e.g. a generator) and yields the results of update as they come.
+
+        :param observations: An iterable of observations
+        :return: A generator of (filtered value, smoothed value of time t-lag or None)
+        """
+        for observation in observations:
+            yield self.update(observation)
+
+
 if __name__ == '__main__':
     print 'Part B\nTask 1'
 
@@ -0,0 +1,204 @@
+"""
+Benchmarks for the decision tree learners in decision_tree.py.
+
+Run from the ex04 directory: python benchmarks.py
+"""
+
+import random
+import time
+import tracemalloc
+
+import numpy as np
+
+import decision_tree as dt
+
+
+def synthetic_examples(number_of_rows, noise=0.1, seed=0, file_path="data/training.txt"):
+    """Makes a larger example set by resampling the rows of a data file and flipping a share of the
+    classifications, so that trees keep growing with the data.
+
+    :param number_of_rows: Number of examples
+    :param noise: Share of examples that get a random classification
+    :param seed: Seed for the sampling
+    :param file_path: The data file to resample
+    :return: Example list
+    """
+    rng = random.Random(seed)
+    source = dt.read_examples(file_path)
+    classes = sorted(set(example[-1] for example in source))
+
+    examples = []
+    for _ in range(number_of_rows):
+        example = list(rng.choice(source))
+        if rng.random() < noise:
+            example[-1] = rng.choice(classes)
+        examples.append(example)
+
+    return examples
+
+
+def synthetic_numeric_examples(number_of_rows, number_of_attributes=5, noise=0.05, decimals=None, seed=0):
+    """Makes examples with numeric attributes, as strings like read_examples gives, classified by a few thresholds
+    on the first attributes and with a share of the classifications flipped.
+
+    :param number_of_rows: Number of examples
+    :param number_of_attributes: Number of numeric attributes
+    :param noise: Share of examples that get the other classification
+    :param decimals: Decimals to round the values to, e.g. 1 for at most a few hundred distinct values
+    :param seed: Seed for the values
+    :return: Example list
+    """
+    rng = np.random.default_rng(seed)
+    values = rng.normal(size=(number_of_rows, number_of_attributes)) * 10
+    if decimals is not None:
+        values = np.round(values, decimals)
+
+    positive = (values[:, 0] > 2) & (values[:, 1] < 5) | (values[:, 0] < -8)
+    positive ^= rng.random(number_of_rows) < noise
+
+    return [["%r" % float(v) for v in row] + ['1' if p else '2'] for row, p in zip(values, positive)]
+
+
+def time_call(function, *args):
+    """Times one call.
+
+    :return: Seconds taken
+    """
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def benchmark_build_scaling(row_counts=(500, 1000, 2000, 4000, 8000)):
+    """Prints how long decision_tree_learning with information_gain takes to build a tree as the number of rows
+    grows, on a plain example list and on IndexedExamples, and the growth factor from the previous row count.
+
+    :param row_counts: Numbers of rows to time
+    """
+    print("%8s %12s %8s %12s %8s" % ('Rows', 'List (s)', 'Growth', 'Indexed (s)', 'Growth'))
+
+    previous = None
+    for number_of_rows in row_counts:
+        examples = synthetic_examples(number_of_rows)
+        attribute_set = set(range(len(examples[0]) - 1))
+        example_numbers = set(range(number_of_rows))
+
+        plain = time_call(dt.decision_tree_learning, examples, example_numbers, attribute_set, None,
+                          dt.information_gain)
+        indexed_examples = dt.IndexedExamples(examples)
+        indexed = time_call(dt.decision_tree_learning, indexed_examples, example_numbers, attribute_set, None,
+                            dt.information_gain)
+
+        if previous is None:
+            print("%8d %12.3f %8s %12.3f %8s" % (number_of_rows, plain, '', indexed, ''))
+        else:
+            print("%8d %12.3f %8.2f %12.3f %8.2f" % (number_of_rows, plain, plain / previous[0], indexed,
+                                                     indexed / previous[1]))
+        previous = plain, indexed
+
+
+def benchmark_levels(number_of_rows=8000, order='breadth'):
+    """Builds one tree with a TreeBuilder and prints its build time and peak memory per level, for sizing jobs.
+
+    :param number_of_rows: Number of examples
+    :param order: 'breadth' or 'best'
+    """
+    examples = dt.IndexedExamples(synthetic_examples(number_of_rows))
+    builder = dt.TreeBuilder(order=order, track_memory=True)
+    builder.build(examples, set(range(number_of_rows)), set(range(len(examples[0]) - 1)))
+    builder.print_levels()
+
+
+def benchmark_histogram_importance(number_of_rows=20000):
+    """Prints how long a tree takes to build with information_gain on a plain example list and with
+    histogram_importance on the same examples as BinnedExamples.
+
+    :param number_of_rows: Number of examples
+    """
+    examples = synthetic_examples(number_of_rows)
+    attribute_set = set(range(len(examples[0]) - 1))
+    example_numbers = set(range(number_of_rows))
+
+    plain = time_call(dt.decision_tree_learning, examples, example_numbers, attribute_set, None, dt.information_gain)
+    binned_examples = dt.BinnedExamples(examples)
+    binned = time_call(dt.decision_tree_learning, binned_examples, example_numbers, attribute_set, None,
+                       dt.histogram_importance)
+
+    print("%8s %12s %12s" % ('Rows', 'List (s)', 'Binned (s)'))
+    print("%8d %12.3f %12.3f" % (number_of_rows, plain, binned))
+
+
+def benchmark_numeric_splits(number_of_rows=40000, max_depth=8):
+    """Prints the build time, peak traced memory and test error rate of a depth-limited tree learned on numeric
+    attributes with exact thresholds (encoded_decision_tree_learning) and with histogram_importance on BinnedExamples,
+    whose threshold is the best of at most 256 bin edges.
+
+    :param number_of_rows: Number of training examples (and of test examples)
+    :param max_depth: Depth limit of the trees
+    """
+    examples = synthetic_numeric_examples(2 * number_of_rows)
+    training_set, test_set = examples[:number_of_rows], examples[number_of_rows:]
+    numeric_attributes = range(len(examples[0]) - 1)
+
+    def measure(learn):
+        tracemalloc.start()
+        start = time.perf_counter()
+        tree = learn()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return seconds, peak, dt.test_for_accuracy(tree, test_set)[0]
+
+    encoded = dt.encode_examples(training_set, numeric_attributes)
+    exact = measure(lambda: dt.encoded_decision_tree_learning(encoded, builder=dt.TreeBuilder(max_depth=max_depth)))
+
+    binned_examples = dt.BinnedExamples(training_set, numeric_attributes)
+    binned = measure(lambda: dt.TreeBuilder(max_depth=max_depth).build(binned_examples, set(range(number_of_rows)),
+                                                                        set(numeric_attributes),
+                                                                        dt.histogram_importance))
+
+    print("%8s %12s %12s %12s" % ('Tree', 'Build (s)', 'Peak (MiB)', 'Test error'))
+    for name, (seconds, peak, error) in (('Exact', exact), ('Binned', binned)):
+        print("%8s %12.3f %12.2f %12.4f" % (name, seconds, peak / 2 ** 20, error))
+
+
+def check_binned_against_threshold_tree(number_of_rows=5000):
+    """Checks that histogram_importance on BinnedExamples splits numeric attributes like encoded_decision_tree_learning
+    does. With at most 256 distinct values per attribute every value gets its own bin, so both learners must make the
+    same splits and classify every training example alike; with more values the binned tree must stay about as
+    accurate on a test set.
+
+    :param number_of_rows: Number of training examples (and of test examples)
+    :raise AssertionError: If the trees disagree
+    """
+    for decimals in (0, None):
+        examples = synthetic_numeric_examples(2 * number_of_rows, decimals=decimals)
+        training_set, test_set = examples[:number_of_rows], examples[number_of_rows:]
+        numeric_attributes = range(len(examples[0]) - 1)
+
+        exact_tree = dt.encoded_decision_tree_learning(dt.encode_examples(training_set, numeric_attributes))
+        binned_tree = dt.decision_tree_learning(dt.BinnedExamples(training_set, numeric_attributes),
+                                                set(range(number_of_rows)), set(numeric_attributes), None,
+                                                dt.histogram_importance)
+
+        if decimals is not None:
+            disagreements = sum(dt.classify(exact_tree, example) != dt.classify(binned_tree, example)
+                                for example in training_set)
+            assert disagreements == 0, '%d training examples classified differently' % disagreements
+
+        exact_error = dt.test_for_accuracy(exact_tree, test_set)[0]
+        binned_error = dt.test_for_accuracy(binned_tree, test_set)[0]
+        assert binned_error <= exact_error + 0.02, 'Binned test error %.4f, exact %.4f' % (binned_error, exact_error)
+
+    print("Binned trees agree with threshold trees")
+
+
+if __name__ == "__main__":
+    benchmark_build_scaling()
+    print()
+    benchmark_levels()
+    print()
+    benchmark_histogram_importance()
+    print()
+    check_binned_against_threshold_tree()
+    benchmark_numeric_splits()
@@ -0,0 +1,226 @@
+"""
+k-fold cross-validation and learning curves for the decision trees in decision_tree.py.
+
+The examples are encoded once. A fold is only a pair of arrays of example numbers (rows) into the encoded examples:
+trees are learned by encoded_decision_tree_learning from the training rows without copying them, and only the test
+rows are copied (by subset) into a small EncodedExamples to classify with the compiled tree. Folds run in a process
+pool whose workers get the encoded examples once, from the pool initializer, as in forest.py. Every fold reports its
+accuracy and the wall time of building and of predicting, so the same runs serve model selection and performance
+regression checks.
+
+Run from the ex04 directory: python cross_validation.py
+"""
+
+import concurrent.futures
+import os
+import statistics
+import time
+
+import numpy as np
+
+import decision_tree as dt
+
+
+_worker_examples = None  # The EncodedExamples of a pool worker, set by _initialize_worker
+
+
+def _initialize_worker(encoded):
+    """Pool initializer: keeps the encoded examples for all folds the worker runs.
+
+    :param encoded: EncodedExamples
+    """
+    global _worker_examples
+    _worker_examples = encoded
+
+
+def k_fold_rows(number_of_examples, k=10, seed=None):
+    """Splits the example numbers into k folds of (almost) equal size, after shuffling them.
+
+    :param number_of_examples: Number of examples
+    :param k: Number of folds
+    :param seed: Seed for the shuffle
+    :return: List of k (training rows, test rows) pairs of ascending arrays
+    """
+    if not 2 <= k <= number_of_examples:
+        raise ValueError('k must be between 2 and the number of examples')
+
+    shuffled = np.random.default_rng(seed).permutation(number_of_examples)
+    folds = np.array_split(shuffled, k)
+
+    return [(np.sort(np.concatenate(folds[:i] + folds[i + 1:])), np.sort(folds[i])) for i in range(k)]
+
+
+def subset(encoded, rows):
+    """The examples of some rows as EncodedExamples with the same value numbering. Copies the rows (fancy indexing).
+
+    :param encoded: EncodedExamples
+    :param rows: Array of example numbers
+    :return: EncodedExamples
+    """
+    numbers = None if encoded.numbers is None else encoded.numbers[rows]
+
+    return dt.EncodedExamples(encoded.codes[rows], encoded.labels[rows], encoded.attribute_values,
+                              encoded.class_values, numbers)
+
+
+def run_fold(fold, training_rows, test_rows, builder_options=None, encoded=None):
+    """Learns a tree from the training rows and tests it on the test rows.
+
+    :param fold: Number of the fold, for the report
+    :param training_rows: Array of example numbers to learn from
+    :param test_rows: Array of example numbers to test on
+    :param builder_options: Dict of TreeBuilder arguments (order, max_depth, min_samples_split, max_leaf_nodes)
+    :param encoded: EncodedExamples. Defaults to the ones the worker was initialized with.
+    :return: A dict with the fold's results
+    """
+    if encoded is None:
+        encoded = _worker_examples
+
+    start = time.perf_counter()
+    tree = dt.encoded_decision_tree_learning(encoded, training_rows, builder=dt.TreeBuilder(**(builder_options or {})))
+    compiled = dt.compile_tree(tree, encoded)
+    build_seconds = time.perf_counter() - start
+
+    test_set = subset(encoded, test_rows)
+    start = time.perf_counter()
+    predictions = compiled.predict_batch(test_set)
+    predict_seconds = time.perf_counter() - start
+
+    return {
+        'fold': fold,
+        'training_size': len(training_rows),
+        'test_size': len(test_rows),
+        'accuracy': float(np.mean(predictions == test_set.labels)),
+        'nodes': len(compiled),
+        'build_seconds': build_seconds,
+        'predict_seconds': predict_seconds,
+    }
+
+
+def run_folds(encoded, folds, builder_options=None, workers=None):
+    """Runs folds, concurrently when workers > 1.
+
+    :param encoded: EncodedExamples
+    :param folds: List of (training rows, test rows)
+    :param builder_options: Dict of TreeBuilder arguments
+    :param workers: Number of processes. Defaults to the number of CPUs; 1 runs the folds in this process.
+    :return: List of result dicts, in fold order
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(folds))
+
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_initialize_worker,
+                                                    initargs=(encoded,)) as executor:
+            futures = [executor.submit(run_fold, i, training_rows, test_rows, builder_options)
+                       for i, (training_rows, test_rows) in enumerate(folds)]
+            return [future.result() for future in futures]
+
+    return [run_fold(i, training_rows, test_rows, builder_options, encoded)
+            for i, (training_rows, test_rows) in enumerate(folds)]
+
+
+def summarize(results):
+    """Sums up the results of some folds.
+
+    :param results: List of result dicts from run_fold
+    :return: Dict with the mean and standard deviation of the accuracy, and the mean build and predict times
+    """
+    accuracies = [result['accuracy'] for result in results]
+
+    return {
+        'folds': len(results),
+        'training_size': statistics.mean(result['training_size'] for result in results),
+        'accuracy_mean': statistics.mean(accuracies),
+        'accuracy_stdev': statistics.stdev(accuracies) if len(accuracies) > 1 else 0.0,
+        'build_seconds_mean': statistics.mean(result['build_seconds'] for result in results),
+        'predict_seconds_mean': statistics.mean(result['predict_seconds'] for result in results),
+    }
+
+
+def cross_validate(examples, k=10, seed=None, workers=None, builder_options=None, numeric_attributes=()):
+    """k-fold cross-validation of encoded_decision_tree_learning.
+
+    :param examples: Example list, as from read_examples, or EncodedExamples
+    :param k: Number of folds
+    :param seed: Seed for the folds
+    :param workers: Number of processes, see run_folds
+    :param builder_options: Dict of TreeBuilder arguments, e.g. {'max_depth': 4}
+    :param numeric_attributes: The numeric attributes, if examples is an example list
+    :return: The result dicts of the folds, and their summary
+    """
+    encoded = examples if isinstance(examples, dt.EncodedExamples) else dt.encode_examples(examples,
+                                                                                           numeric_attributes)
+    results = run_folds(encoded, k_fold_rows(len(encoded), k, seed), builder_options, workers)
+
+    return results, summarize(results)
+
+
+def learning_curve(examples, training_shares=(0.1, 0.25, 0.5, 0.75, 1.0), k=5, seed=None, workers=None,
+                   builder_options=None, numeric_attributes=()):
+    """Cross-validates trees learned from growing shares of each fold's training rows, testing on the whole fold.
+
+    :param examples: Example list, as from read_examples, or EncodedExamples
+    :param training_shares: Shares of the training rows to learn from
+    :param k: Number of folds
+    :param seed: Seed for the folds and the training subsets
+    :param workers: Number of processes, see run_folds
+    :param builder_options: Dict of TreeBuilder arguments
+    :param numeric_attributes: The numeric attributes, if examples is an example list
+    :return: List with a summary (see summarize) per share, with the share added
+    """
+    encoded = examples if isinstance(examples, dt.EncodedExamples) else dt.encode_examples(examples,
+                                                                                           numeric_attributes)
+    rng = np.random.default_rng(seed)
+    folds = k_fold_rows(len(encoded), k, seed)
+
+    # Every share learns from a prefix of the same shuffled training rows, so larger shares only add examples
+    shuffled = [rng.permutation(training_rows) for training_rows, _ in folds]
+
+    all_folds = []
+    for share in training_shares:
+        for (training_rows, test_rows), order in zip(folds, shuffled):
+            size = max(1, int(round(share * len(training_rows))))
+            all_folds.append((np.sort(order[:size]), test_rows))
+
+    results = run_folds(encoded, all_folds, builder_options, workers)
+
+    curve = []
+    for i, share in enumerate(training_shares):
+        summary = summarize(results[i * k:(i + 1) * k])
+        summary['share'] = share
+        curve.append(summary)
+
+    return curve
+
+
+def print_results(results, summary):
+    """Prints the results of a cross-validation.
+
+    :param results: List of result dicts from run_fold
+    :param summary: Their summary
+    """
+    print("%5s %9s %9s %9s %7s %10s %12s" % ('Fold', 'Training', 'Test', 'Accuracy', 'Nodes', 'Build (s)',
+                                             'Predict (s)'))
+    for result in results:
+        print("%5d %9d %9d %9.4f %7d %10.4f %12.6f" % (result['fold'], result['training_size'], result['test_size'],
+                                                       result['accuracy'], result['nodes'], result['build_seconds'],
+                                                       result['predict_seconds']))
+
+    print("Accuracy %.4f +- %.4f, build %.4f s, predict %.6f s per fold" % (
+        summary['accuracy_mean'], summary['accuracy_stdev'], summary['build_seconds_mean'],
+        summary['predict_seconds_mean']))
+
+
+if __name__ == "__main__":
+    examples = dt.read_examples("data/training.txt") + dt.read_examples("data/test.txt")
+
+    print("10-fold cross-validation")
+    print_results(*cross_validate(examples, k=10, seed=0))
+
+    print("\nLearning curve (5 folds)")
+    print("%7s %9s %9s %9s %10s" % ('Share', 'Training', 'Accuracy', 'Stdev', 'Build (s)'))
+    for point in learning_curve(examples, k=5, seed=0):
+        print("%7.2f %9.1f %9.4f %9.4f %10.4f" % (point['share'], point['training_size'], point['accuracy_mean'],
+                                                  point['accuracy_stdev'], point['build_seconds_mean']))
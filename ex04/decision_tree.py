@@ -1,7 +1,11 @@
 __author__ = 'eirikvageskar'
+import collections
+import heapq
 import random
 import math
-import pydot
+import time
+import tracemalloc
+import numpy as np
 
 """
 This file solves Exercise 4 given in Artificial Intelligence Methods (TDT4171) at NTNU in march 2015.
@@ -34,89 +38,169 @@ def plurality_value(examples, example_numbers):
     return max(counts, key=lambda x: counts[x])
 
 
-def boolean_entropy(q):
+def entropy(counts):
     """
-    Boolean entropy for a variable with probability q of being true
+    Entropy of a variable with any number of values, given how often each value occurs
 
-    :param q: The probability of the variable being true
-    :return: Boolean entropy
+    :param counts: The counts of each value (e.g. the values of a class count histogram)
+    :return: Entropy in bits
     """
 
-    try:
-        return -(q*math.log2(q)+(1-q)*math.log2(1-q))
-    except ValueError:  # Happens if q is 1 or 0, which causes a problem with the logarithm function.
-        return 0
+    counts = [c for c in counts if c > 0]
+    total = sum(counts)
 
+    return -sum((c/total)*math.log2(c/total) for c in counts)
 
-def find_true_count(examples, example_numbers):
+
+class NodeStatistics:
+    """
+    Class count histograms of a node: class_counts maps each classification to its count in the node, and
+    value_counts[a][v] is the class count histogram of the node's examples that have value v for attribute a
+    (None until node_statistics has counted them).
+    """
+
+    def __init__(self, class_counts, value_counts):
+        self.class_counts = class_counts
+        self.value_counts = value_counts
+
+    def child_class_counts(self, attribute, value):
+        """
+        The class counts of the child reached by a value of an attribute. They are already known from this node's
+        histograms, so the child does not need to count them again.
+
+        :param attribute: The attribute split on
+        :param value: The attribute value of the child
+        :return: A dict mapping classification to count
+        """
+        return self.value_counts[attribute].get(value, {})
+
+    def split(self, examples, attribute, values):
+        """
+        Makes the statistics the children of a split start from: their class counts, from this node's histograms.
+
+        :param examples: The entire set of examples.
+        :param attribute: The attribute split on
+        :param values: Dict from value to the example numbers of the child, as from find_values_and_example_numbers
+        :return: Dict from value to NodeStatistics without value_counts
+        """
+        return {v: NodeStatistics(self.child_class_counts(attribute, v), None) for v in values}
+
+    def can_split(self, attribute):
+        """
+        :return: Whether splitting on the attribute is possible. Always, for attributes split on every value.
+        """
+        return True
+
+    def threshold(self, attribute):
+        """
+        :return: The threshold to split a numeric attribute on, or None for an attribute split on every value
+        """
+        return None
+
+
+def find_class_counts(examples, example_numbers):
     """
-    Finds the number of specimen in the subset whose classification is True.
-    True is assumed to be the largest of the result values.
+    Counts the classifications in a subset, in the order they first occur.
 
     :param examples: The entire set of examples.
     :param example_numbers: The subset in question.
-    :return: The proportion of true variables.
+    :return: A dict mapping classification to count
     """
 
-    true_value = max(examples, key=lambda x: x[-1])[-1]
+    counts = {}
 
-    true_count = 0
     for e in example_numbers:
-        if examples[e][-1] == true_value:
-            true_count += 1
+        result = examples[e][-1]
+        counts[result] = counts.get(result, 0) + 1
 
-    return true_count
+    return counts
 
 
-def remainder(examples, example_numbers, a):
+def node_statistics(examples, example_numbers, attribute_set, class_counts=None):
+    """
+    Builds the class count histograms of every attribute in the subset in a single pass over it.
+
+    :param examples: The entire set of examples.
+    :param example_numbers: The subset in question.
+    :param attribute_set: The attributes to count for.
+    :param class_counts: The class counts of the subset, if already known.
+    :return: NodeStatistics, or HistogramStatistics for BinnedExamples
+    """
+
+    if isinstance(examples, BinnedExamples):
+        return HistogramStatistics(examples, examples.histograms(example_numbers))
+
+    attributes = list(attribute_set)
+    value_counts = {a: {} for a in attributes}
+    count_classes = class_counts is None
+    if count_classes:
+        class_counts = {}
+
+    for e in example_numbers:
+        example = examples[e]
+        result = example[-1]
+        if count_classes:
+            class_counts[result] = class_counts.get(result, 0) + 1
+        for a in attributes:
+            histogram = value_counts[a].setdefault(example[a], {})
+            histogram[result] = histogram.get(result, 0) + 1
+
+    return NodeStatistics(class_counts, value_counts)
+
+
+def remainder(examples, example_numbers, a, statistics=None):
     """
     Finds expected entropy after testing attribute a.
 
     :param examples: The entire set of examples.
     :param example_numbers: The subset in question.
     :param a: The attribute in question.
+    :param statistics: NodeStatistics of the subset covering a. Counted here if not given.
     :return: Expected remaining entropy.
     """
 
-    values = find_values_and_example_numbers(examples, example_numbers, a)
+    if statistics is None:
+        statistics = node_statistics(examples, example_numbers, [a])
 
     remainder_sum = 0
     p_plus_n = len(example_numbers)
-    for k in values:
-        pk_plus_nk = len(values[k])
-        pk = find_true_count(examples, values[k])
-        boolean_entropy_of_k_set = boolean_entropy(pk/pk_plus_nk)
-        remainder_sum += (pk_plus_nk/p_plus_n)*boolean_entropy_of_k_set
+    for histogram in statistics.value_counts[a].values():  # Values no example takes on add nothing
+        pk_plus_nk = sum(histogram.values())
+        remainder_sum += (pk_plus_nk/p_plus_n)*entropy(histogram.values())
 
     return remainder_sum
 
 
-def random_importance(examples, example_numbers, a):
+def random_importance(examples, example_numbers, a, statistics=None):
     """
     A sheep function in wolf's clothing: Returns a random number.
 
     :param examples: Argument added to make it replaceable with information_gain.
     :param example_numbers: Argument added to make it replaceable with information_gain.
     :param a: Argument added to make it replaceable with information_gain.
+    :param statistics: Argument added to make it replaceable with information_gain.
     :return: A random number between 0 and 1.
     """
     return random.random()
 
 
-def information_gain(examples, example_numbers, a):
+def information_gain(examples, example_numbers, a, statistics=None):
     """
-    Finds the information gain from splitting the subset using attribute a.
+    Finds the information gain from splitting the subset using attribute a. Works for any number of classes.
 
     :param examples: The entire set of examples.
     :param example_numbers: The subset in question.
     :param a: The attribute in question.
+    :param statistics: NodeStatistics of the subset covering a. Counted here if not given.
     :return: Information gain.
     """
 
-    probability_of_true = find_true_count(examples, example_numbers)/len(example_numbers)
-    b = boolean_entropy(probability_of_true)
+    if statistics is None:
+        statistics = node_statistics(examples, example_numbers, [a])
+
+    b = entropy(statistics.class_counts.values())
 
-    remainder_of_a = remainder(examples, example_numbers, a)
+    remainder_of_a = remainder(examples, example_numbers, a, statistics)
 
     return b - remainder_of_a
 
@@ -130,13 +214,25 @@ def find_values_and_example_numbers(examples, example_numbers, attribute):
     :param attribute: The attribute to be examined.
     :return: A dictionary containing attributes and sets of examples.
     """
-    values = {}
+    if isinstance(examples, BinnedExamples):
+        # Every value of a categorical attribute has a bin and gets a branch, in bin order
+        rows = examples.rows(example_numbers)
+        column = examples.bins[rows, attribute]
+        return {v: rows[column == b] for b, v in enumerate(examples.bin_values[attribute])}
+
+    if isinstance(examples, IndexedExamples):
+        # The value domain is known up front, so only the subset itself needs to be visited
+        if len(example_numbers) == len(examples):
+            return {v: set(rows) for v, rows in examples.inverted_lists[attribute].items()}
+        values = {v: set() for v in examples.value_domains[attribute]}
+    else:
+        values = {}
+
+        for ex in examples:
+            val = ex[attribute]
+            if val not in values:
+                values[val] = set()
 
-    for ex in examples:
-        val = ex[attribute]
-        if val not in values:
-            values[val] = set()
-    
     for e in example_numbers:  # For every example number in question
         v = examples[e][attribute]
         values[v].add(e)  # Add example number e to the set of examples
@@ -144,69 +240,954 @@ def find_values_and_example_numbers(examples, example_numbers, attribute):
     return values
 
 
-def have_same_classification(examples, example_numbers):
+class IndexedExamples(list):
+    """
+    An example list with an index built once over the whole set: the value domain of every column (in order of first
+    appearance), and inverted lists mapping each value to the sorted numbers of the examples that have it. It can be
+    used wherever an example list is used. With it, find_values_and_example_numbers no longer scans every example, so
+    splitting a node costs time proportional to the node's size rather than to the whole set.
     """
-    Helper method that checks if all examples in the subset have the same classification.
 
-    :param examples: The entire set of examples.
+    def __init__(self, examples):
+        super().__init__(examples)
+
+        self.inverted_lists = []
+        for column in zip(*self):
+            inverted_list = {}
+            for e, v in enumerate(column):
+                if v in inverted_list:
+                    inverted_list[v].append(e)
+                else:
+                    inverted_list[v] = [e]
+            self.inverted_lists.append(inverted_list)
+
+        self.value_domains = [list(inverted_list) for inverted_list in self.inverted_lists]
+
+
+class BinnedExamples:
+    """
+    An example list quantized for histogram_importance: every attribute is numbered into at most max_bins bins, kept
+    as a uint8 matrix bins[i, a], with labels[i] the index of example i's classification in class_values. It indexes
+    like the example list it was made from, which it refers to rather than copies. Categorical
+    values get a bin each, in order of first appearance, and are split on every value. Numeric attributes are cut
+    into bins holding about equally many examples (one per value if there are at most max_bins), and are split in
+    two at the bin edge with the highest information gain, as encoded_decision_tree_learning splits them at a value:
+    into a node {"root_test": a, "threshold": t, "<=": ..., ">": ...} that classify evaluates on the raw values.
+
+    node_statistics counts the class histograms of all attributes of a node with one bincount, and the largest
+    child's histograms come from its parent's by subtracting its siblings' (see HistogramStatistics.split), so a
+    node's split search costs time proportional to bins rather than examples. The children of a split get their
+    example numbers as int64 arrays, which take a fraction of the memory of sets.
+    """
+
+    def __init__(self, examples, numeric_attributes=(), max_bins=256):
+        if not 1 <= max_bins <= 256:
+            raise ValueError('max_bins must be between 1 and 256, so bins fit in uint8')
+
+        self.examples = examples
+
+        number_of_attributes = len(examples[0]) - 1
+        columns = list(zip(*examples))
+
+        self.bin_edges = [None] * number_of_attributes
+        self.bin_values = [None] * number_of_attributes
+        bins = np.empty((len(examples), number_of_attributes), dtype=np.uint8)
+        bins_per_attribute = []
+        for a in range(number_of_attributes):
+            if a in numeric_attributes:
+                try:
+                    numbers = np.array(columns[a], dtype=np.float64)
+                except ValueError as e:
+                    raise ValueError('Attribute %d is not numeric: %s' % (a, e))
+                distinct = np.unique(numbers)
+                if len(distinct) <= max_bins:
+                    edges = (distinct[:-1] + distinct[1:]) / 2
+                else:
+                    edges = np.unique(np.quantile(numbers, np.linspace(0, 1, max_bins + 1)[1:-1]))
+                self.bin_edges[a] = edges
+                bins[:, a] = np.searchsorted(edges, numbers)  # Bin k holds values in (edges[k-1], edges[k]]
+                bins_per_attribute.append(len(edges) + 1)
+            else:
+                value_numbers = {}
+                bins[:, a] = [value_numbers.setdefault(v, len(value_numbers)) for v in columns[a]]
+                if len(value_numbers) > max_bins:
+                    raise ValueError('Attribute %d has more than %d values; treat it as numeric' % (a, max_bins))
+                self.bin_values[a] = list(value_numbers)
+                bins_per_attribute.append(len(value_numbers))
+
+        class_numbers = {}
+        self.labels = np.array([class_numbers.setdefault(v, len(class_numbers)) for v in columns[-1]], dtype=np.int64)
+        self.class_values = list(class_numbers)
+        self.bins = bins
+        self.number_of_bins = max(bins_per_attribute or [1])
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, i):
+        return self.examples[i]
+
+    @property
+    def numeric_attributes(self):
+        return [a for a, edges in enumerate(self.bin_edges) if edges is not None]
+
+    @staticmethod
+    def rows(example_numbers):
+        """
+        :param example_numbers: A set, or int64 array as made by the splits, of example numbers
+        :return: The example numbers as an int64 array
+        """
+        if isinstance(example_numbers, np.ndarray):
+            return example_numbers
+
+        return np.fromiter(example_numbers, dtype=np.int64, count=len(example_numbers))
+
+    def histograms(self, example_numbers):
+        """
+        Counts the class histogram of every bin of every attribute in a subset with one bincount.
+
+        :param example_numbers: The subset in question.
+        :return: An (attributes x bins x classes) array of counts
+        """
+        rows = self.rows(example_numbers)
+        number_of_attributes = self.bins.shape[1]
+        number_of_classes = len(self.class_values)
+
+        # Computed in place, so only one (examples x attributes) array of cell numbers is alive at a time
+        cells = self.bins[rows].astype(np.int64)
+        cells += np.arange(number_of_attributes) * self.number_of_bins
+        cells *= number_of_classes
+        cells += self.labels[rows, np.newaxis]
+        histograms = np.bincount(cells.ravel(),
+                                 minlength=number_of_attributes * self.number_of_bins * number_of_classes)
+
+        return histograms.reshape(number_of_attributes, self.number_of_bins, number_of_classes)
+
+    def split_on_threshold(self, example_numbers, attribute, threshold):
+        """
+        Splits a subset on a bin edge of a numeric attribute.
+
+        :param example_numbers: The subset in question.
+        :param attribute: The numeric attribute
+        :param threshold: One of the attribute's bin edges
+        :return: A dict from "<=" and ">" to int64 arrays of example numbers
+        """
+        rows = self.rows(example_numbers)
+        below = self.bins[rows, attribute] <= np.searchsorted(self.bin_edges[attribute], threshold)
+
+        return {"<=": rows[below], ">": rows[~below]}
+
+
+class _BinnedValueCounts(dict):
+    """
+    The value_counts of NodeStatistics for a HistogramStatistics, built for an attribute when first asked for.
+    """
+
+    def __init__(self, statistics):
+        super().__init__()
+        self.statistics = statistics
+
+    def __missing__(self, a):
+        statistics = self.statistics
+        examples, histograms = statistics.examples, statistics.histograms
+
+        if examples.bin_edges[a] is None:
+            counts = {examples.bin_values[a][b]: histograms[a, b] for b in np.flatnonzero(histograms[a].sum(axis=1))}
+        elif statistics.can_split(a):  # The two sides of the best cut
+            below = histograms[a, :statistics.cuts[a] + 1].sum(axis=0)
+            counts = {"<=": below, ">": statistics.class_totals - below}
+        else:
+            counts = {"<=": statistics.class_totals}
+
+        self[a] = {v: {examples.class_values[k]: int(histogram[k]) for k in np.flatnonzero(histogram)}
+                   for v, histogram in counts.items()}
+        return self[a]
+
+
+class HistogramStatistics:
+    """
+    The statistics node_statistics makes for BinnedExamples: histograms[a, b, k] counts the node's examples of class
+    k in bin b of attribute a. It has the class_counts and value_counts of NodeStatistics, so information_gain works
+    with it too, and gains() scores all attributes at once for histogram_importance.
+    """
+
+    def __init__(self, examples, histograms):
+        self.examples = examples
+        self.histograms = histograms
+        self.class_totals = histograms[0].sum(axis=0)
+        self.class_counts = {examples.class_values[k]: int(self.class_totals[k])
+                             for k in np.flatnonzero(self.class_totals)}
+        self.value_counts = _BinnedValueCounts(self)
+        self._gains = None
+        self._cuts = None
+
+    def gains(self):
+        """
+        :return: Array with the information gain of each attribute, rounded so that near-equal gains tie. Numeric
+            attributes get the gain of their best cut, or -inf if all examples are in one bin.
+        """
+        if self._gains is None:
+            self._score()
+
+        return self._gains
+
+    @property
+    def cuts(self):
+        """
+        Dict from each numeric attribute to the bin after which its best cut lies, or None if it cannot be cut.
+        """
+        if self._cuts is None:
+            self._score()
+
+        return self._cuts
+
+    def _score(self):
+        number_of_rows = self.class_totals.sum()
+        node_entropy = entropy_of_counts(self.class_totals)
+
+        bin_counts = self.histograms.sum(axis=2)
+        remainders = (bin_counts / number_of_rows * entropy_of_counts(self.histograms)).sum(axis=1)
+        gains = np.round(node_entropy - remainders, 12)
+
+        # Numeric attributes: a cumulative sum over the bins gives the class counts below every cut at once
+        numeric = self.examples.numeric_attributes
+        self._cuts = {}
+        if numeric and self.examples.number_of_bins > 1:
+            below = np.cumsum(self.histograms[numeric], axis=1)[:, :-1]
+            above = self.class_totals - below
+            number_below = below.sum(axis=2)
+
+            cut_remainders = (number_below * entropy_of_counts(below) +
+                              (number_of_rows - number_below) * entropy_of_counts(above)) / number_of_rows
+            cut_gains = np.round(node_entropy - cut_remainders, 12)
+            cut_gains[(number_below == 0) | (number_below == number_of_rows)] = -np.inf
+
+            for a, attribute_gains in zip(numeric, cut_gains):
+                best = int(np.argmax(attribute_gains))
+                gains[a] = attribute_gains[best]
+                self._cuts[a] = best if attribute_gains[best] > -np.inf else None
+        else:
+            for a in numeric:
+                gains[a] = -np.inf
+                self._cuts[a] = None
+
+        self._gains = gains
+
+    def can_split(self, attribute):
+        """
+        :return: Whether splitting on the attribute is possible: numeric attributes need examples in two bins
+        """
+        return self.examples.bin_edges[attribute] is None or self.cuts[attribute] is not None
+
+    def threshold(self, attribute):
+        """
+        :return: The bin edge of the best cut of a numeric attribute, or None for a categorical attribute
+        """
+        if self.examples.bin_edges[attribute] is None:
+            return None
+
+        return float(self.examples.bin_edges[attribute][self.cuts[attribute]])
+
+    def split(self, examples, attribute, values):
+        """
+        Makes the statistics of the children of a split. Only the smaller children are counted; the largest child's
+        histograms are this node's minus its siblings', subtracted in place, so this node's histograms are handed on
+        rather than kept.
+
+        :param examples: The entire set of examples (the BinnedExamples).
+        :param attribute: The attribute split on
+        :param values: Dict from value (or "<=" and ">") to the example numbers of the child
+        :return: Dict from value to HistogramStatistics (None for empty children, which need none)
+        """
+        largest = max(values, key=lambda v: len(values[v]))
+
+        children = {}
+        remaining, self.histograms = self.histograms, None
+        for v in values:
+            if len(values[v]) == 0:
+                children[v] = None
+            elif v != largest:
+                children[v] = HistogramStatistics(examples, examples.histograms(values[v]))
+                remaining -= children[v].histograms
+        children[largest] = HistogramStatistics(examples, remaining)
+
+        return {v: children[v] for v in values}
+
+
+def histogram_importance(examples, example_numbers, a, statistics=None):
+    """
+    Information gain scored on the bin histograms of BinnedExamples. The gains of all attributes of a node are
+    computed in one vectorized step, the first time any of them is asked for.
+
+    :param examples: The entire set of examples, as BinnedExamples.
     :param example_numbers: The subset in question.
-    :return:
+    :param a: The attribute in question.
+    :param statistics: HistogramStatistics of the subset. Counted here if not given.
+    :return: Information gain.
     """
-    random_index = random.sample(example_numbers, 1)[0]
-    random_result = examples[random_index][-1]
 
-    for e in example_numbers:  # Check if all examples have same classification
-        if examples[e][-1] != random_result:
-            return False
+    if statistics is None:
+        statistics = node_statistics(examples, example_numbers, [a])
+
+    if not isinstance(statistics, HistogramStatistics):
+        raise TypeError('histogram_importance needs BinnedExamples')
 
-    return random_result  # No longer as random; we now know that all examples in subset share the value
+    return statistics.gains()[a]
 
 
-def decision_tree_learning(examples, example_numbers, attribute_set, parent_example_numbers, importance):
+def split_examples(examples, example_numbers, attribute_set, attribute, statistics):
+    """
+    Splits a subset on an attribute: on every value, or, for a numeric attribute of BinnedExamples, in two on the
+    threshold its statistics found. A numeric attribute stays in the attribute set of the children.
+
+    :param examples: The entire set of examples.
+    :param example_numbers: The subset in question.
+    :param attribute_set: The attributes still to be decided on.
+    :param attribute: The attribute to split on.
+    :param statistics: NodeStatistics (or HistogramStatistics) of the subset.
+    :return: The node's dict without children, a dict from branch to example numbers, and the children's attribute set
+    """
+    threshold = statistics.threshold(attribute)
+    if threshold is None:
+        return ({"root_test": attribute}, find_values_and_example_numbers(examples, example_numbers, attribute),
+                attribute_set.difference([attribute]))
+
+    return ({"root_test": attribute, "threshold": threshold},
+            examples.split_on_threshold(example_numbers, attribute, threshold), attribute_set)
+
+
+def decision_tree_learning(examples, example_numbers, attribute_set, parent_example_numbers, importance,
+                           statistics=None):
     """
     Returns a decision tree.
     Builds on fig. 18.5 from Artificial Intelligence: A modern approach.
 
+    The class count histograms of all attributes are counted in one pass per node (see node_statistics) and handed
+    to the importance function, and each child starts from statistics its parent made (see NodeStatistics.split).
+
     :param examples: The complete set of examples to work on.
     :param example_numbers: The indices of the examples to be examined.
     :param attribute_set: The set of attributes still to be decided on.
     :param parent_example_numbers: The example_numbers of this branch's parent.
-    :param importance: Function used to judge importance of an attribute.
+    :param importance: Function used to judge importance of an attribute, called as
+        importance(examples, example_numbers, a, statistics).
+    :param statistics: Statistics of the examples from the parent, at least their class counts, if already known.
     :return: The decision tree.
     """
 
     if len(example_numbers) == 0:  # Example subset is empty
         return plurality_value(examples, parent_example_numbers)
 
-    same_classification_check = have_same_classification(examples, example_numbers)
-    if same_classification_check:  # All examples have the same classification
-        return same_classification_check
+    if statistics is None:
+        statistics = NodeStatistics(find_class_counts(examples, example_numbers), None)
+    class_counts = statistics.class_counts
+
+    if len(class_counts) == 1:  # All examples have the same classification
+        return next(iter(class_counts))
 
     if len(attribute_set) == 0:  # Attribute set is empty
         return plurality_value(examples, example_numbers)
 
+    if statistics.value_counts is None:
+        statistics = node_statistics(examples, example_numbers, attribute_set, class_counts)
+
     max_importance = -1  # Dummy importance value
+    argmax = None
 
     for a in attribute_set:
-        a_importance = importance(examples, example_numbers, a)
+        if not statistics.can_split(a):  # A numeric attribute on which all examples agree
+            continue
+        a_importance = importance(examples, example_numbers, a, statistics)
         if a_importance > max_importance:
             max_importance = a_importance
             argmax = a
 
-    # Construct a new tree to be returned
-    tree = {"root_test": argmax}
-
-    # Find values of argmax-attribute and the training_set that take on those values
-    values = find_values_and_example_numbers(examples, example_numbers, argmax)
+    if argmax is None:  # Nothing left to split on
+        return plurality_value(examples, example_numbers)
 
-    new_attribute_set = attribute_set.difference([argmax])
+    # Construct a new tree to be returned, with the values (or sides of the threshold) of argmax and the examples
+    # that take on those values
+    tree, values, new_attribute_set = split_examples(examples, example_numbers, attribute_set, argmax, statistics)
+    child_statistics = statistics.split(examples, argmax, values)
 
     for v in values:  # Construct subtrees for every possible value argmax can take on
-        tree[v] = decision_tree_learning(examples, values[v], new_attribute_set, example_numbers, importance)
+        tree[v] = decision_tree_learning(examples, values[v], new_attribute_set, example_numbers, importance,
+                                         child_statistics[v])
 
     return tree
 
 
+class EncodedExamples:
+    """
+    A set of examples with every attribute value and classification encoded once as a small integer.
+    codes[i, a] is the index of example i's value of attribute a in attribute_values[a], and labels[i] the index of its
+    classification in class_values. Values are numbered in order of first appearance, which is the order
+    find_values_and_example_numbers discovers them in.
+
+    Numeric attributes are not numbered: attribute_values[a] is None, codes[:, a] is 0, and the values are kept as
+    floats in numbers[:, a]. numbers is NaN in the other columns, and None if no attribute is numeric.
+    """
+
+    def __init__(self, codes, labels, attribute_values, class_values, numbers=None):
+        self.codes = codes
+        self.labels = labels
+        self.attribute_values = attribute_values
+        self.class_values = class_values
+        self.numbers = numbers
+
+    @property
+    def numeric_attributes(self):
+        return [a for a, values in enumerate(self.attribute_values) if values is None]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def encode(self, examples):
+        """
+        Encodes more examples (e.g. a test set) with this set's value numbering.
+
+        :param examples: Example list, as from read_examples
+        :return: EncodedExamples sharing this set's attribute_values and class_values
+        """
+        codes = np.zeros((len(examples), len(self.attribute_values)), dtype=self.codes.dtype)
+        labels = np.empty(len(examples), dtype=self.labels.dtype)
+
+        value_numbers = [{v: k for k, v in enumerate(values)} for values in self.attribute_values if values is not None]
+        categorical = [a for a, values in enumerate(self.attribute_values) if values is not None]
+        class_numbers = {v: k for k, v in enumerate(self.class_values)}
+
+        try:
+            for i, example in enumerate(examples):
+                for a, numbering in zip(categorical, value_numbers):
+                    codes[i, a] = numbering[example[a]]
+                labels[i] = class_numbers[example[-1]]
+        except KeyError as e:
+            raise ValueError('Value not seen in the encoded examples: ' + str(e))
+
+        numbers = None
+        if self.numbers is not None:
+            numbers = numeric_columns(examples, self.numeric_attributes, len(self.attribute_values))
+
+        return EncodedExamples(codes, labels, self.attribute_values, self.class_values, numbers)
+
+
+def smallest_code_dtype(number_of_values):
+    """
+    Finds the smallest unsigned integer type that can number the given number of values.
+
+    :param number_of_values: Number of distinct values
+    :return: A NumPy dtype
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if number_of_values <= np.iinfo(dtype).max + 1:
+            return dtype
+
+    return np.uint64
+
+
+def numeric_columns(examples, numeric_attributes, number_of_attributes):
+    """
+    Parses the numeric attributes of a list of examples as floats.
+
+    :param examples: Example list, as from read_examples
+    :param numeric_attributes: The numeric attributes
+    :param number_of_attributes: Number of attributes
+    :return: An (examples x attributes) float array, NaN in the other columns
+    """
+    numbers = np.full((len(examples), number_of_attributes), np.nan)
+    for a in numeric_attributes:
+        try:
+            numbers[:, a] = [float(example[a]) for example in examples]
+        except ValueError as e:
+            raise ValueError('Attribute %d is not numeric: %s' % (a, e))
+
+    return numbers
+
+
+def encode_examples(examples, numeric_attributes=()):
+    """
+    Encodes a list of examples into an EncodedExamples.
+
+    :param examples: Example list, as from read_examples
+    :param numeric_attributes: The attributes to treat as numbers, split on thresholds instead of on every value
+    :return: EncodedExamples
+    """
+    number_of_attributes = len(examples[0]) - 1
+    numeric_attributes = sorted(set(numeric_attributes))
+    columns = list(zip(*examples))
+
+    attribute_values = []
+    codes = []
+    for a in range(number_of_attributes):
+        if a in numeric_attributes:
+            codes.append([0] * len(examples))
+            attribute_values.append(None)
+            continue
+        value_numbers = {}
+        codes.append([value_numbers.setdefault(v, len(value_numbers)) for v in columns[a]])
+        attribute_values.append(list(value_numbers))
+
+    class_numbers = {}
+    labels = [class_numbers.setdefault(v, len(class_numbers)) for v in columns[-1]]
+    class_values = list(class_numbers)
+
+    widest = max([len(values) for values in attribute_values if values is not None] or [1])
+    codes = np.array(codes, dtype=smallest_code_dtype(widest)).T.reshape(len(examples), number_of_attributes)
+    labels = np.array(labels, dtype=smallest_code_dtype(len(class_values)))
+
+    numbers = None
+    if numeric_attributes:
+        numbers = numeric_columns(examples, numeric_attributes, number_of_attributes)
+
+    return EncodedExamples(codes, labels, attribute_values, class_values, numbers)
+
+
+def entropy_of_counts(counts, axis=-1):
+    """
+    Entropy (in bits) of the class distributions given by class count histograms along an axis.
+
+    :param counts: Array of class counts
+    :param axis: The axis holding the classes
+    :return: Array of entropies, 0 for empty histograms
+    """
+    totals = counts.sum(axis=axis, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = counts / totals
+        terms = np.where(counts > 0, p * np.log2(p), 0.0)
+
+    return -terms.sum(axis=axis)
+
+
+def encoded_information_gains(encoded, rows):
+    """
+    Finds the information gain of splitting a subset on each attribute, for all attributes in one vectorized step.
+    One bincount gives the class histogram of every (attribute, value) combination in the subset.
+
+    :param encoded: EncodedExamples
+    :param rows: Array with the example numbers of the subset
+    :return: Array with the information gain of each attribute (numeric attributes get the gain of not splitting)
+    """
+    number_of_attributes = encoded.codes.shape[1]
+    number_of_values = max([len(values) for values in encoded.attribute_values if values is not None] or [1])
+    number_of_classes = len(encoded.class_values)
+
+    codes = encoded.codes[rows].astype(np.int64)
+    labels = encoded.labels[rows].astype(np.int64)
+
+    cells = (np.arange(number_of_attributes) * number_of_values + codes) * number_of_classes + labels[:, np.newaxis]
+    histograms = np.bincount(cells.ravel(), minlength=number_of_attributes * number_of_values * number_of_classes)
+    histograms = histograms.reshape(number_of_attributes, number_of_values, number_of_classes)
+
+    value_counts = histograms.sum(axis=2)
+    remainders = (value_counts / len(rows) * entropy_of_counts(histograms)).sum(axis=1)
+    node_entropy = entropy_of_counts(np.bincount(labels, minlength=number_of_classes))
+
+    return node_entropy - remainders
+
+
+def encoded_plurality_value(encoded, rows):
+    """
+    Finds the most common classification in a subset, breaking ties like plurality_value: by whichever class comes
+    first among the (ascending) example numbers.
+
+    :param encoded: EncodedExamples
+    :param rows: Array with the example numbers of the subset, in ascending order
+    :return: The class index
+    """
+    labels = encoded.labels[rows]
+    counts = np.bincount(labels, minlength=len(encoded.class_values))
+    candidates = np.flatnonzero(counts == counts.max())
+
+    if len(candidates) == 1:
+        return candidates[0]
+
+    return labels[np.isin(labels, candidates)][0]
+
+
+def best_threshold(encoded, sorted_rows, attribute):
+    """
+    Finds the threshold on a numeric attribute with the highest information gain, in one sweep over the examples in
+    order of their values: a cumulative sum of the classifications gives the class counts below every candidate
+    threshold at once.
+
+    :param encoded: EncodedExamples
+    :param sorted_rows: Array with the example numbers of the subset, in order of their value of the attribute
+    :param attribute: The numeric attribute
+    :return: The information gain and the threshold, or -inf and None if all examples have the same value
+    """
+    values = encoded.numbers[sorted_rows, attribute]
+    boundaries = np.flatnonzero(values[:-1] < values[1:])  # Split after these positions
+    if len(boundaries) == 0:
+        return -np.inf, None
+
+    number_of_classes = len(encoded.class_values)
+    one_hot = np.eye(number_of_classes, dtype=np.int64)[encoded.labels[sorted_rows]]
+    cumulative = np.cumsum(one_hot, axis=0)
+
+    below = cumulative[boundaries]
+    above = cumulative[-1] - below
+    number_below = boundaries + 1
+    number_of_rows = len(sorted_rows)
+
+    remainders = (number_below * entropy_of_counts(below) +
+                  (number_of_rows - number_below) * entropy_of_counts(above)) / number_of_rows
+    gains = np.round(entropy_of_counts(cumulative[-1]) - remainders, 12)
+
+    best = int(np.argmax(gains))
+    position = boundaries[best]
+
+    return float(gains[best]), float((values[position] + values[position + 1]) / 2)
+
+
+def encoded_decision_tree_learning(encoded, example_numbers=None, attribute_set=None, max_features=None, rng=None,
+                                   builder=None):
+    """
+    Returns the decision tree that decision_tree_learning builds with information_gain, in the same nested dict
+    format, but learned from EncodedExamples. Class histograms come from bincount and the gains of all candidate
+    attributes are scored in one vectorized step per node.
+
+    Numeric attributes are split in two on the threshold found by best_threshold, into a node
+    {"root_test": a, "threshold": t, "<=": ..., ">": ...}, and stay available below it. Each numeric column is sorted
+    once, here; the children keep their share of their parent's order, so no node sorts again.
+
+    With max_features, each split only considers that many attributes, drawn at random from those still available
+    (as in a random forest).
+
+    :param encoded: EncodedExamples, e.g. from encode_examples
+    :param example_numbers: The indices of the examples to be examined, repeats allowed (e.g. a bootstrap sample).
+        Defaults to all.
+    :param attribute_set: The set of attributes to be decided on. Defaults to all.
+    :param max_features: Number of attributes to consider per split, or None for all of them.
+    :param rng: numpy.random.Generator for drawing the attributes. Defaults to a fresh one.
+    :param builder: TreeBuilder with the growth order and limits to use. Defaults to an unlimited one.
+    :return: The decision tree.
+    """
+    if example_numbers is None:
+        rows = np.arange(len(encoded))
+    else:
+        rows = np.array(sorted(example_numbers), dtype=np.int64)
+
+    available = np.zeros(encoded.codes.shape[1], dtype=bool)
+    available[list(range(len(available)) if attribute_set is None else list(attribute_set))] = True
+
+    if max_features is not None and rng is None:
+        rng = np.random.default_rng()
+
+    if builder is None:
+        builder = TreeBuilder()
+
+    orders = {a: rows[np.argsort(encoded.numbers[rows, a], kind='stable')] for a in encoded.numeric_attributes}
+
+    return builder.grow(EncodedSplitter(encoded, max_features, rng), (rows, available, rows, orders))
+
+
+class ExampleListSplitter:
+    """
+    The split rules of decision_tree_learning, for TreeBuilder. A node's state is a tuple (example_numbers,
+    attribute_set, parent_example_numbers, statistics), where statistics are those made by the parent (see
+    NodeStatistics.split); children of a node share one attribute set.
+    """
+
+    def __init__(self, examples, importance):
+        self.examples = examples
+        self.importance = importance
+
+    def size(self, state):
+        return len(state[0])
+
+    def leaf(self, state):
+        """
+        :return: The classification if the node must be a leaf whatever the limits, else None
+        """
+        example_numbers, attribute_set, parent_example_numbers, statistics = state
+
+        if len(example_numbers) == 0:  # Example subset is empty
+            return plurality_value(self.examples, parent_example_numbers)
+        if len(statistics.class_counts) == 1:  # All examples have the same classification
+            return next(iter(statistics.class_counts))
+        if len(attribute_set) == 0:  # Attribute set is empty
+            return plurality_value(self.examples, example_numbers)
+
+        return None
+
+    def plurality(self, state):
+        return plurality_value(self.examples, state[0])
+
+    def best_split(self, state):
+        """
+        :return: The most important attribute (None if there is nothing to split on) and its importance, and what
+            split() needs from this step
+        """
+        example_numbers, attribute_set, parent_example_numbers, statistics = state
+        if statistics.value_counts is None:
+            statistics = node_statistics(self.examples, example_numbers, attribute_set, statistics.class_counts)
+
+        argmax, max_importance = None, -1  # Dummy importance value
+        for a in attribute_set:
+            if not statistics.can_split(a):
+                continue
+            a_importance = self.importance(self.examples, example_numbers, a, statistics)
+            if a_importance > max_importance:
+                argmax, max_importance = a, a_importance
+
+        return argmax, max_importance, statistics
+
+    def split(self, state, attribute, statistics):
+        """
+        :return: The node's dict, without children, and a list of (value, child state)
+        """
+        example_numbers, attribute_set = state[0], state[1]
+        node, values, child_attribute_set = split_examples(self.examples, example_numbers, attribute_set, attribute,
+                                                           statistics)
+        child_statistics = statistics.split(self.examples, attribute, values)
+
+        return node, [(v, (values[v], child_attribute_set, example_numbers, child_statistics[v])) for v in values]
+
+
+class EncodedSplitter:
+    """
+    The split rules of encoded_decision_tree_learning, for TreeBuilder. A node's state is a tuple (rows, available,
+    parent_rows, orders) of ascending example numbers, a boolean mask of the attributes still to be decided on, the
+    parent's example numbers, and a dict with the example numbers in order of value for every numeric attribute.
+    """
+
+    def __init__(self, encoded, max_features=None, rng=None):
+        self.encoded = encoded
+        self.max_features = max_features
+        self.rng = rng
+
+    def size(self, state):
+        return len(state[0])
+
+    def leaf(self, state):
+        rows, available, parent_rows = state[:3]
+        encoded = self.encoded
+
+        if len(rows) == 0:  # Example subset is empty
+            return encoded.class_values[encoded_plurality_value(encoded, parent_rows)]
+
+        labels = encoded.labels[rows]
+        if np.all(labels == labels[0]):  # All examples have the same classification
+            return encoded.class_values[labels[0]]
+
+        if not available.any():  # Attribute set is empty
+            return encoded.class_values[encoded_plurality_value(encoded, rows)]
+
+        return None
+
+    def plurality(self, state):
+        return self.encoded.class_values[encoded_plurality_value(self.encoded, state[0])]
+
+    def best_split(self, state):
+        rows, available, parent_rows, orders = state
+
+        # Rounding makes near-equal gains tie, so the first attribute wins as in decision_tree_learning
+        gains = np.round(encoded_information_gains(self.encoded, rows), 12)
+        candidates = available
+        if self.max_features is not None and self.max_features < available.sum():
+            candidates = np.zeros_like(available)
+            candidates[self.rng.choice(np.flatnonzero(available), self.max_features, replace=False)] = True
+
+        thresholds = {}
+        for a in orders:
+            if candidates[a]:
+                gains[a], thresholds[a] = best_threshold(self.encoded, orders[a], a)
+
+        gains[~candidates] = -np.inf
+        argmax = int(np.argmax(gains))
+        if gains[argmax] == -np.inf:  # Only numeric attributes on which all examples agree
+            return None, None, None
+
+        return argmax, float(gains[argmax]), thresholds.get(argmax)
+
+    def split(self, state, attribute, threshold):
+        rows, available, parent_rows, orders = state
+
+        if threshold is not None:
+            below = self.encoded.numbers[rows, attribute] <= threshold
+            node = {"root_test": attribute, "threshold": threshold}
+            return node, self._children(rows, available, orders, below.astype(np.int8), ["<=", ">"], [1, 0])
+
+        child_available = available.copy()
+        child_available[attribute] = False
+
+        values = self.encoded.attribute_values[attribute]
+        column = self.encoded.codes[rows, attribute]
+        return {"root_test": attribute}, self._children(rows, child_available, orders, column, values,
+                                                        range(len(values)))
+
+    def _children(self, rows, available, orders, child_codes, keys, codes):
+        """
+        Splits rows and the numeric orders by a code per row. An example's code is spread over all example numbers,
+        so each order can be split by looking up the code of its example numbers, which keeps it sorted.
+
+        :return: List of (key, child state)
+        """
+        code_of_example = None
+        if orders:
+            code_of_example = np.empty(len(self.encoded), dtype=child_codes.dtype)
+            code_of_example[rows] = child_codes
+        order_codes = {a: code_of_example[order] for a, order in orders.items()}
+
+        return [(key, (rows[child_codes == code], available, rows,
+                       {a: order[order_codes[a] == code] for a, order in orders.items()}))
+                for key, code in zip(keys, codes)]
+
+
+class TreeBuilder:
+    """
+    Grows a decision tree from an explicit work queue instead of recursion, so the depth of a tree is not bounded by
+    Python's recursion limit. Nodes are split breadth first ('breadth') or, for 'best', in order of their importance
+    weighted by their number of examples, which decides which nodes get split when max_leaf_nodes runs out.
+
+    After grow(), levels holds one dict per depth with the number of nodes and leaves made at that depth, the seconds
+    spent on them and, with track_memory, the peak of traced memory (in bytes) while they were made.
+    """
+
+    def __init__(self, order='breadth', max_depth=None, min_samples_split=2, max_leaf_nodes=None,
+                 track_memory=False):
+        """
+        :param order: 'breadth' or 'best'
+        :param max_depth: Depth at which nodes become leaves (the root has depth 0), or None
+        :param min_samples_split: Nodes with fewer examples become leaves
+        :param max_leaf_nodes: Largest number of leaves in the tree, or None
+        :param track_memory: Whether to measure peak memory per level with tracemalloc (which slows building)
+        """
+        if order not in ('breadth', 'best'):
+            raise ValueError('Unknown order: ' + str(order))
+        if max_leaf_nodes is not None and max_leaf_nodes < 1:
+            raise ValueError('max_leaf_nodes must be at least 1')
+
+        self.order = order
+        self.max_depth = max_depth
+        self.min_samples_split = min_samples_split
+        self.max_leaf_nodes = max_leaf_nodes
+        self.track_memory = track_memory
+        self.levels = []
+
+    def build(self, examples, example_numbers, attribute_set, importance=information_gain):
+        """
+        Builds the tree decision_tree_learning would build, within this builder's limits.
+
+        :param examples: The complete set of examples to work on.
+        :param example_numbers: The indices of the examples to be examined.
+        :param attribute_set: The set of attributes to be decided on.
+        :param importance: Function used to judge importance of an attribute.
+        :return: The decision tree.
+        """
+        splitter = ExampleListSplitter(examples, importance)
+        statistics = NodeStatistics(find_class_counts(examples, example_numbers), None)
+
+        return self.grow(splitter, (example_numbers, set(attribute_set), example_numbers, statistics))
+
+    def grow(self, splitter, root_state):
+        """
+        Grows a tree with the split rules of a splitter (ExampleListSplitter or EncodedSplitter).
+
+        :param splitter: Object with size, leaf, plurality, best_split and split methods for its node states, like
+            ExampleListSplitter
+        :param root_state: State of the root node
+        :return: The decision tree.
+        """
+        self.levels = []
+        started_tracing = self.track_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+
+        try:
+            root = {}
+            self._queue = [] if self.order == 'best' else collections.deque()
+            self._leaves = 0
+            self._counter = 0  # Keeps the heap stable, so equally important nodes are split in the order queued
+
+            self._place(splitter, root_state, 0, root, None)
+
+            while self._queue:
+                if self.order == 'best':
+                    _, _, state, depth, parent, key, attribute, found = heapq.heappop(self._queue)
+                else:
+                    state, depth, parent, key, attribute, found = self._queue.popleft()
+
+                level = self._start(depth)
+                tree, children = splitter.split(state, attribute, found)
+
+                leaves_after_split = self._leaves + len(self._queue) + len(children)
+                if self.max_leaf_nodes is not None and leaves_after_split > self.max_leaf_nodes:
+                    parent[key] = splitter.plurality(state)
+                    self._leaves += 1
+                    level['leaves'] += 1
+                    self._stop(level)
+                    continue
+
+                parent[key] = tree
+                self._stop(level)
+
+                for v, child_state in children:
+                    tree[v] = None  # Keeps the values in order while the children wait in the queue
+                    self._place(splitter, child_state, depth + 1, tree, v)
+
+            return root[None]
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+
+    def _place(self, splitter, state, depth, parent, key):
+        """
+        Makes a node a leaf, or finds its split and queues it.
+        """
+        level = self._start(depth)
+        level['nodes'] += 1
+
+        classification = splitter.leaf(state)
+        if classification is None and ((self.max_depth is not None and depth >= self.max_depth) or
+                                       splitter.size(state) < self.min_samples_split):
+            classification = splitter.plurality(state)
+
+        attribute = None
+        if classification is None:
+            attribute, importance, found = splitter.best_split(state)
+            if attribute is None:
+                classification = splitter.plurality(state)
+
+        if classification is not None:
+            parent[key] = classification
+            self._leaves += 1
+            level['leaves'] += 1
+        else:
+            if self.order == 'best':
+                heapq.heappush(self._queue, (-importance * splitter.size(state), self._counter, state, depth, parent,
+                                             key, attribute, found))
+                self._counter += 1
+            else:
+                self._queue.append((state, depth, parent, key, attribute, found))
+
+        self._stop(level)
+
+    def _start(self, depth):
+        while len(self.levels) <= depth:
+            self.levels.append({'depth': len(self.levels), 'nodes': 0, 'leaves': 0, 'seconds': 0.0,
+                                'peak_bytes': 0 if self.track_memory else None})
+
+        level = self.levels[depth]
+        if self.track_memory:
+            tracemalloc.reset_peak()
+        level['_start'] = time.perf_counter()
+
+        return level
+
+    def _stop(self, level):
+        level['seconds'] += time.perf_counter() - level.pop('_start')
+        if self.track_memory:
+            level['peak_bytes'] = max(level['peak_bytes'], tracemalloc.get_traced_memory()[1])
+
+    def print_levels(self):
+        """Prints the level report of the last tree grown."""
+        print("%6s %8s %8s %10s %12s" % ('Depth', 'Nodes', 'Leaves', 'Seconds', 'Peak (MiB)'))
+        for level in self.levels:
+            peak = '' if level['peak_bytes'] is None else '%.2f' % (level['peak_bytes'] / 2 ** 20)
+            print("%6d %8d %8d %10.4f %12s" % (level['depth'], level['nodes'], level['leaves'], level['seconds'], peak))
+
+
 def read_examples(file_path):
     """
     Read examples from a file and put them in a list.
@@ -231,11 +1212,15 @@ def classify(decision_tree, example):
     :return: Classification
     """
 
-    if type(decision_tree) is not dict:  # We have reached a leaf node
-        return decision_tree
+    while type(decision_tree) is dict:  # Walk down until we reach a leaf node
+        test_attribute = decision_tree["root_test"]
+        if "threshold" in decision_tree:  # A numeric attribute
+            below = float(example[test_attribute]) <= decision_tree["threshold"]
+            decision_tree = decision_tree["<=" if below else ">"]
+        else:
+            decision_tree = decision_tree[example[test_attribute]]
 
-    test_attribute = decision_tree["root_test"]
-    return classify(decision_tree[example[test_attribute]], example)
+    return decision_tree
 
 
 def test_for_accuracy(decision_tree, test_set):
@@ -259,33 +1244,192 @@ def test_for_accuracy(decision_tree, test_set):
     return len(erroneous_indices)/len(test_set), erroneous_indices
 
 
+class CompiledTree:
+    """
+    A decision tree flattened into arrays for fast classification. Node 0 is the root. For an inner node n,
+    feature[n] is the tested attribute and children[child_offset[n] + code] the node reached by the value with that
+    code (-1 if the tree has no branch for it). If the attribute is numeric, threshold[n] is the node's threshold and
+    code is 0 for values up to it and 1 for those above; threshold is NaN for other nodes. For a leaf, feature[n] is
+    -1 and leaf_value[n] the index of its classification in class_values.
+    """
+
+    def __init__(self, feature, child_offset, children, leaf_value, attribute_values, class_values, threshold=None):
+        if threshold is None:
+            threshold = np.full(len(feature), np.nan)
+
+        self.feature = feature
+        self.child_offset = child_offset
+        self.children = children
+        self.leaf_value = leaf_value
+        self.threshold = threshold
+        self.attribute_values = attribute_values
+        self.class_values = class_values
+        self.value_numbers = [None if values is None else {v: k for k, v in enumerate(values)}
+                              for values in attribute_values]
+
+        self._node_lists = None
+
+    def __len__(self):
+        return len(self.feature)
+
+    @property
+    def node_lists(self):
+        """
+        Plain list copies of the node arrays for predict_one; indexing lists is much cheaper than indexing arrays one
+        item at a time. Made on first use, so a memory-mapped tree (see tree_model.load_model) is not read in full
+        until it is needed.
+        """
+        if self._node_lists is None:
+            self._node_lists = (self.feature.tolist(), self.child_offset.tolist(), self.children.tolist(),
+                                self.leaf_value.tolist(), self.threshold.tolist())
+
+        return self._node_lists
+
+    def predict_batch(self, codes):
+        """
+        Classifies a whole matrix of encoded examples. All examples move down one level per step, so the number of
+        NumPy steps is the depth of the tree rather than the number of examples.
+
+        :param codes: An (examples x attributes) code matrix, or EncodedExamples (needed if the tree tests numeric
+            attributes)
+        :return: Array with the class index of each example (see class_values)
+        """
+        numbers = None
+        if isinstance(codes, EncodedExamples):
+            codes, numbers = codes.codes, codes.numbers
+
+        numeric = ~np.isnan(self.threshold)
+        if numeric.any() and numbers is None:
+            raise ValueError('The tree tests numeric attributes, so it needs EncodedExamples with numbers')
+
+        nodes = np.zeros(len(codes), dtype=np.int64)
+        active = np.arange(len(codes))
+
+        while len(active):
+            features = self.feature[nodes[active]]
+            inner = features >= 0
+            active, features = active[inner], features[inner]
+
+            if len(active) == 0:
+                break
+
+            branches = codes[active, features].astype(np.int64)
+            if numbers is not None:
+                thresholds = self.threshold[nodes[active]]
+                by_threshold = ~np.isnan(thresholds)
+                branches[by_threshold] = numbers[active[by_threshold], features[by_threshold]] > thresholds[by_threshold]
+
+            next_nodes = self.children[self.child_offset[nodes[active]] + branches]
+            if np.any(next_nodes < 0):
+                raise ValueError('The tree has no branch for a value of example %d' % active[np.argmin(next_nodes)])
+            nodes[active] = next_nodes
+
+        return self.leaf_value[nodes]
+
+    def predict_one(self, example):
+        """
+        Classifies a single (unencoded) example with a plain loop, for low-latency use.
+
+        :param example: The specimen, as a list of attribute values
+        :return: Classification
+        """
+        features, child_offset, children, leaf_value, thresholds = self.node_lists
+
+        node = 0
+        feature = features[node]
+
+        while feature >= 0:
+            if self.value_numbers[feature] is None:  # A numeric attribute
+                branch = int(float(example[feature]) > thresholds[node])
+            else:
+                branch = self.value_numbers[feature][example[feature]]
+            node = children[child_offset[node] + branch]
+            if node < 0:
+                raise ValueError('The tree has no branch for value %s of attribute %d' % (example[feature], feature))
+            feature = features[node]
+
+        return self.class_values[leaf_value[node]]
+
+
+def compile_tree(decision_tree, encoded):
+    """
+    Flattens a nested dict decision tree into a CompiledTree, breadth first and without recursion.
+
+    :param decision_tree: A decision tree (or leaf node), as from decision_tree_learning
+    :param encoded: EncodedExamples whose value numbering the compiled tree will use
+    :return: A CompiledTree
+    """
+    class_numbers = {v: k for k, v in enumerate(encoded.class_values)}
+
+    feature = []
+    leaf_value = []
+    child_offset = []
+    children = []
+    threshold = []
+
+    queue = [decision_tree]
+    for node in queue:  # The queue grows while we walk it
+        if type(node) is not dict:
+            feature.append(-1)
+            leaf_value.append(class_numbers[node])
+            child_offset.append(-1)
+            threshold.append(np.nan)
+            continue
+
+        attribute = node["root_test"]
+        feature.append(attribute)
+        leaf_value.append(-1)
+        child_offset.append(len(children))
+        threshold.append(node.get("threshold", np.nan))
+
+        for v in ("<=", ">") if "threshold" in node else encoded.attribute_values[attribute]:
+            if v in node:
+                children.append(len(queue))
+                queue.append(node[v])
+            else:
+                children.append(-1)
+
+    return CompiledTree(np.array(feature, dtype=np.int32), np.array(child_offset, dtype=np.int64),
+                        np.array(children, dtype=np.int32), np.array(leaf_value, dtype=np.int32),
+                        encoded.attribute_values, encoded.class_values, np.array(threshold, dtype=np.float64))
+
+
 def build_graph(graph, node, address=""):
-    """Builds a graph of the decision tree in the dot language recursively.
-    This depends on the pydot library (pydot3k), which again depends on GraphViz.
+    """Builds a graph of the decision tree in the dot language, breadth first and without recursion.
+    This depends on the pydot library (pydot3k), which again depends on GraphViz. It is only imported here, so
+    learning, loading and classifying trees do not need it.
 
     :param graph: The graph we are working with. Must be declared from the outside.
     :param node: The node being examined (a dictionary).
     :param address: The address of this node (sequence of attribute values thus far; a unique address)
-    :return: The pydot Node being that has been constructed for this dictionary node. Necessary for recursion.
+    :return: The pydot Node that has been constructed for this dictionary node.
     """
 
-    this_node = pydot.Node(address, label=node["root_test"])  # Construct this node
-    graph.add_node(this_node)  # Add it to the graph
-    for key in node:  # For all keys
-        if key == 'root_test':  # ... except the one telling us which attribute is being tested
-            continue
-        value = node[key]
-        child_address = address+"."+str(key)  # Make a unique address for the child node
-        if type(value) is dict:
-            # Build the graph for the child and then connect the parent node to it
-            graph.add_edge(pydot.Edge(this_node, build_graph(graph, value, child_address), label=key))
-        else:
-            # The child is a classification leaf node. It needs no subgraph building
-            classification_node = pydot.Node(child_address, label=value, shape="rectangle")
-            graph.add_node(classification_node)
-            graph.add_edge(pydot.Edge(this_node, classification_node, label=key))
-
-    return this_node
+    import pydot
+
+    root_node = pydot.Node(address, label=node["root_test"])  # Construct the root node
+    graph.add_node(root_node)  # Add it to the graph
+
+    queue = collections.deque([(node, address, root_node)])
+    while queue:
+        node, address, this_node = queue.popleft()
+        for key in node:  # For all keys
+            if key in ('root_test', 'threshold'):  # ... except the ones telling us which test is being made
+                continue
+            value = node[key]
+            child_address = address+"."+str(key)  # Make a unique address for the child node
+            label = key if "threshold" not in node else "%s %g" % (key, node["threshold"])
+            if type(value) is dict:
+                # Construct the child node, connect the parent node to it and build its graph later
+                child_node = pydot.Node(child_address, label=value["root_test"])
+                queue.append((value, child_address, child_node))
+            else:
+                # The child is a classification leaf node. It needs no subgraph building
+                child_node = pydot.Node(child_address, label=value, shape="rectangle")
+            graph.add_node(child_node)
+            graph.add_edge(pydot.Edge(this_node, child_node, label=label))
+
+    return root_node
 
 
 if __name__ == "__main__":
@@ -316,6 +1460,8 @@ if __name__ == "__main__":
     for item in bad_accuracies:
         print(item)
 
+    import pydot
+
     good_graph = pydot.Dot(graph_type='digraph')
     build_graph(good_graph, good_decision_tree)
     good_graph.write('good_decision_tree.eps', format="eps")
@@ -0,0 +1,194 @@
+"""
+Random forests (and plain bagging) of the decision trees in decision_tree.py.
+
+Every tree is learned by encoded_decision_tree_learning from a bootstrap sample of the examples, considering a random
+subset of the attributes at each split. The trees are learned in a process pool: each worker gets the encoded examples
+once, from the pool initializer, and every task only sends a seed and gets a compiled tree back. Prediction runs all
+compiled trees on a code matrix and takes a vectorized majority vote.
+
+Run from the ex04 directory: python forest.py
+"""
+
+import concurrent.futures
+import math
+import os
+
+import numpy as np
+
+import decision_tree as dt
+
+
+_worker_examples = None  # The EncodedExamples of a pool worker, set by _initialize_worker
+
+
+def _initialize_worker(encoded):
+    """Pool initializer: keeps the encoded examples for all trees the worker learns.
+
+    :param encoded: EncodedExamples
+    """
+    global _worker_examples
+    _worker_examples = encoded
+
+
+def resolve_max_features(max_features, number_of_attributes):
+    """Turns a max_features setting into a number of attributes.
+
+    :param max_features: 'sqrt', 'log2', a share of the attributes (float), a number (int), or None for all
+    :param number_of_attributes: Number of attributes in the examples
+    :return: Number of attributes to consider per split, or None for all
+    """
+    if max_features is None:
+        return None
+    if max_features == 'sqrt':
+        number = int(math.sqrt(number_of_attributes))
+    elif max_features == 'log2':
+        number = int(math.log2(number_of_attributes))
+    elif isinstance(max_features, float):
+        number = int(max_features * number_of_attributes)
+    else:
+        number = int(max_features)
+
+    return min(max(number, 1), number_of_attributes)
+
+
+def learn_tree(seed, max_features=None, bootstrap=True, encoded=None):
+    """Learns and compiles one tree of a forest.
+
+    :param seed: numpy.random.SeedSequence (or int) for the bootstrap sample and the attribute draws
+    :param max_features: Number of attributes to consider per split, or None for all
+    :param bootstrap: Whether to learn from a bootstrap sample rather than all examples
+    :param encoded: EncodedExamples. Defaults to the ones the worker was initialized with.
+    :return: A CompiledTree
+    """
+    if encoded is None:
+        encoded = _worker_examples
+
+    rng = np.random.default_rng(seed)
+    if bootstrap:
+        rows = np.sort(rng.integers(0, len(encoded), len(encoded)))
+    else:
+        rows = None
+
+    tree = dt.encoded_decision_tree_learning(encoded, rows, max_features=max_features, rng=rng)
+
+    return dt.compile_tree(tree, encoded)
+
+
+class Forest:
+    """
+    A list of compiled trees sharing one value numbering, which vote on the classification.
+    """
+
+    def __init__(self, trees, encoded):
+        """
+        :param trees: List of CompiledTree
+        :param encoded: The EncodedExamples the trees were learned from, whose value numbering they use
+        """
+        self.trees = trees
+        self.attribute_values = encoded.attribute_values
+        self.class_values = encoded.class_values
+        numbers = None if encoded.numbers is None else encoded.numbers[:0]
+        self._encoder = dt.EncodedExamples(encoded.codes[:0], encoded.labels[:0], encoded.attribute_values,
+                                           encoded.class_values, numbers)
+
+    def __len__(self):
+        return len(self.trees)
+
+    def encode(self, examples):
+        """Encodes examples with the forest's value numbering.
+
+        :param examples: Example list, as from read_examples
+        :return: EncodedExamples
+        """
+        return self._encoder.encode(examples)
+
+    def votes(self, codes):
+        """Counts the votes of all trees for every example.
+
+        :param codes: An (examples x attributes) code matrix, or EncodedExamples (needed with numeric attributes)
+        :return: An (examples x classes) array of vote counts
+        """
+        number_of_classes = len(self.class_values)
+        predictions = np.stack([tree.predict_batch(codes) for tree in self.trees]).astype(np.int64)
+
+        # One bincount over (example, class) cells counts the votes of all trees at once
+        cells = np.arange(len(codes)) * number_of_classes + predictions
+        return np.bincount(cells.ravel(), minlength=len(codes) * number_of_classes).reshape(len(codes),
+                                                                                           number_of_classes)
+
+    def predict_batch(self, codes):
+        """Classifies encoded examples by majority vote. Ties go to the class that comes first in class_values.
+
+        :param codes: An (examples x attributes) code matrix, or EncodedExamples (needed with numeric attributes)
+        :return: Array with the class index of each example (see class_values)
+        """
+        return np.argmax(self.votes(codes), axis=1)
+
+    def classify(self, examples):
+        """Classifies (unencoded) examples by majority vote.
+
+        :param examples: Example list, as from read_examples
+        :return: List of classifications
+        """
+        return [self.class_values[k] for k in self.predict_batch(self.encode(examples))]
+
+    def test_for_accuracy(self, test_set):
+        """Like decision_tree.test_for_accuracy, but returns the error rate of the forest.
+
+        :param test_set: Example list
+        :return: Error rate, and the erroneous indices
+        """
+        encoded = self.encode(test_set)
+        erroneous_indices = np.flatnonzero(self.predict_batch(encoded) != encoded.labels).tolist()
+
+        return len(erroneous_indices)/len(test_set), erroneous_indices
+
+
+def learn_forest(examples, number_of_trees=10, max_features='sqrt', bootstrap=True, workers=None, seed=None,
+                 numeric_attributes=()):
+    """Learns a random forest. With max_features=None every split considers all attributes, which is plain bagging.
+
+    :param examples: Example list, as from read_examples, or EncodedExamples
+    :param number_of_trees: Number of trees
+    :param max_features: Attributes to consider per split, see resolve_max_features
+    :param bootstrap: Whether each tree learns from a bootstrap sample rather than all examples
+    :param workers: Number of processes. Defaults to the number of CPUs; 1 learns in this process.
+    :param seed: Seed for the forest. The trees do not depend on the number of workers.
+    :param numeric_attributes: The numeric attributes, split on thresholds, if examples is an example list
+    :return: A Forest
+    """
+    if isinstance(examples, dt.EncodedExamples):
+        encoded = examples
+    else:
+        encoded = dt.encode_examples(examples, numeric_attributes)
+    max_features = resolve_max_features(max_features, encoded.codes.shape[1])
+    seeds = np.random.SeedSequence(seed).spawn(number_of_trees)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, number_of_trees)
+
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_initialize_worker,
+                                                    initargs=(encoded,)) as executor:
+            trees = list(executor.map(learn_tree, seeds, [max_features] * number_of_trees,
+                                      [bootstrap] * number_of_trees))
+    else:
+        trees = [learn_tree(s, max_features, bootstrap, encoded) for s in seeds]
+
+    return Forest(trees, encoded)
+
+
+if __name__ == "__main__":
+    training_set = dt.read_examples("data/training.txt")
+    test_examples = dt.read_examples("data/test.txt")
+
+    single_tree = dt.encoded_decision_tree_learning(dt.encode_examples(training_set))
+    print("Single tree accuracy and erroneous indices")
+    print(dt.test_for_accuracy(single_tree, test_examples))
+
+    for max_features, name in ((None, "Bagging"), ('sqrt', "Random forest")):
+        print("\n%s (100 trees) accuracies and erroneous indices" % name)
+        for run in range(5):
+            forest = learn_forest(training_set, number_of_trees=100, max_features=max_features, seed=run)
+            print(forest.test_for_accuracy(test_examples))
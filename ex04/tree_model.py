@@ -0,0 +1,205 @@
+"""
+Saving and loading decision trees for serving, without retraining and without pydot/GraphViz.
+
+A model is a CompiledTree (see decision_tree.compile_tree). The binary format is:
+
+    8 bytes    magic, b'DTMODEL\\0'
+    4 bytes    format version (little-endian uint32)
+    4 bytes    length of the metadata (little-endian uint32)
+    metadata   UTF-8 JSON: attribute_values, class_values, and name, dtype, shape and offset of every node array
+    padding    up to a multiple of ALIGNMENT bytes
+    arrays     the node arrays, each starting at a multiple of ALIGNMENT bytes after the padding
+
+so load_model can memory-map the node arrays instead of reading them, and a serving process starts in about the time
+it takes to parse the metadata. The JSON format holds the same metadata with the arrays as lists, for inspection and
+for tools without NumPy.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+import decision_tree as dt
+
+
+MAGIC = b'DTMODEL\0'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+ARRAY_NAMES = ('feature', 'child_offset', 'children', 'leaf_value', 'threshold')
+
+
+def _metadata(compiled):
+    return {
+        'format_version': FORMAT_VERSION,
+        'number_of_nodes': len(compiled),
+        'attribute_values': compiled.attribute_values,
+        'class_values': compiled.class_values,
+    }
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def save_model(model, file_path, encoded=None, file_format=None):
+    """Saves a tree as a model file.
+
+    :param model: A CompiledTree, or a nested dict decision tree together with encoded
+    :param file_path: The output file
+    :param encoded: EncodedExamples whose value numbering a nested dict tree is compiled with
+    :param file_format: 'binary' or 'json'. Defaults to 'json' if the file name ends in .json, else 'binary'.
+    """
+    if not isinstance(model, dt.CompiledTree):
+        if encoded is None:
+            raise ValueError('A nested dict tree needs the EncodedExamples to compile it with')
+        model = dt.compile_tree(model, encoded)
+
+    if file_format is None:
+        file_format = 'json' if file_path.endswith('.json') else 'binary'
+
+    metadata = _metadata(model)
+    arrays = [np.ascontiguousarray(getattr(model, name)) for name in ARRAY_NAMES]
+
+    if file_format == 'json':
+        metadata['arrays'] = {name: array.tolist() for name, array in zip(ARRAY_NAMES, arrays)}
+        metadata['arrays']['threshold'] = [None if np.isnan(t) else t for t in metadata['arrays']['threshold']]
+        with open(file_path, 'w') as f:
+            json.dump(metadata, f)
+        return
+
+    if file_format != 'binary':
+        raise ValueError('Unknown model format: ' + str(file_format))
+
+    offset = 0
+    descriptions = []
+    for name, array in zip(ARRAY_NAMES, arrays):
+        descriptions.append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+        offset = _aligned(offset + array.nbytes)
+    metadata['arrays'] = descriptions
+
+    metadata_bytes = json.dumps(metadata).encode('utf-8')
+    header = MAGIC + struct.pack('<II', FORMAT_VERSION, len(metadata_bytes))
+    data_start = _aligned(len(header) + len(metadata_bytes))
+
+    with open(file_path, 'wb') as f:
+        f.write(header)
+        f.write(metadata_bytes)
+        for description, array in zip(descriptions, arrays):
+            f.write(b'\0' * (data_start + description['offset'] - f.tell()))
+            f.write(array.tobytes())
+
+
+def _read_binary_header(f):
+    """Reads the header and metadata of a binary model file.
+
+    :return: The metadata, and the offset of the arrays in the file
+    """
+    header = f.read(len(MAGIC) + 8)
+    if header[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a decision tree model file')
+
+    version, metadata_length = struct.unpack('<II', header[len(MAGIC):])
+    if version > FORMAT_VERSION:
+        raise ValueError('Model format version %d is newer than the supported version %d' % (version,
+                                                                                              FORMAT_VERSION))
+
+    metadata = json.loads(f.read(metadata_length).decode('utf-8'))
+
+    return metadata, _aligned(len(header) + metadata_length)
+
+
+def load_model(file_path, mmap=True):
+    """Loads a model file saved by save_model, in either format.
+
+    :param file_path: The model file
+    :param mmap: Whether to memory-map the node arrays of a binary model (read-only) rather than read them
+    :return: A CompiledTree
+    """
+    with open(file_path, 'rb') as f:
+        is_binary = f.read(len(MAGIC)) == MAGIC
+
+    if not is_binary:
+        try:
+            with open(file_path) as f:
+                metadata = json.load(f)
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            raise ValueError('Not a decision tree model file')
+        if metadata.get('format_version', 0) > FORMAT_VERSION:
+            raise ValueError('Model format version %d is newer than the supported version %d' % (
+                metadata['format_version'], FORMAT_VERSION))
+        arrays = metadata['arrays']
+        arrays['threshold'] = [np.nan if t is None else t for t in arrays['threshold']]
+        return dt.CompiledTree(np.array(arrays['feature'], dtype=np.int32),
+                               np.array(arrays['child_offset'], dtype=np.int64),
+                               np.array(arrays['children'], dtype=np.int32),
+                               np.array(arrays['leaf_value'], dtype=np.int32), metadata['attribute_values'],
+                               metadata['class_values'], np.array(arrays['threshold'], dtype=np.float64))
+
+    with open(file_path, 'rb') as f:
+        metadata, data_start = _read_binary_header(f)
+
+        arrays = {}
+        for description in metadata['arrays']:
+            dtype, shape = np.dtype(description['dtype']), tuple(description['shape'])
+            offset = data_start + description['offset']
+            if mmap and np.prod(shape) > 0:  # A memmap cannot be empty
+                arrays[description['name']] = np.memmap(file_path, dtype=dtype, mode='r', offset=offset, shape=shape)
+            else:
+                f.seek(offset)
+                arrays[description['name']] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+    return dt.CompiledTree(arrays['feature'], arrays['child_offset'], arrays['children'], arrays['leaf_value'],
+                           metadata['attribute_values'], metadata['class_values'], arrays['threshold'])
+
+
+def decompile_tree(compiled):
+    """Turns a CompiledTree back into a nested dict decision tree, e.g. to classify or draw a loaded model.
+
+    :param compiled: A CompiledTree
+    :return: The decision tree
+    """
+    feature, child_offset, children, leaf_value, threshold = compiled.node_lists
+
+    def node_value(n):
+        if feature[n] < 0:
+            return compiled.class_values[leaf_value[n]]
+        return {"root_test": feature[n]}
+
+    root = node_value(0)
+    queue = [(0, root)]
+    for n, tree in queue:  # The queue grows while we walk it
+        if type(tree) is not dict:
+            continue
+
+        a = feature[n]
+        if compiled.attribute_values[a] is None:
+            tree["threshold"] = threshold[n]
+            keys = ("<=", ">")
+        else:
+            keys = compiled.attribute_values[a]
+
+        for code, key in enumerate(keys):
+            child = children[child_offset[n] + code]
+            if child >= 0:
+                tree[key] = node_value(child)
+                queue.append((child, tree[key]))
+
+    return root
+
+
+if __name__ == "__main__":
+    import time
+
+    training_set = dt.read_examples("data/training.txt")
+    test_examples = dt.read_examples("data/test.txt")
+    encoded = dt.encode_examples(training_set)
+
+    save_model(dt.encoded_decision_tree_learning(encoded), "decision_tree.model", encoded)
+
+    start = time.perf_counter()
+    model = load_model("decision_tree.model")
+    print("Loaded in %.2f ms" % ((time.perf_counter() - start) * 1000))
+
+    predictions = model.predict_batch(encoded.encode(test_examples))
+    print("Test error rate: %.4f" % np.mean(predictions != encoded.encode(test_examples).labels))
@@ -1,6 +1,9 @@
+import collections
 import math
 import random
-import copy
+import statistics
+
+import numpy as np
 
 
 def log_func(x):
@@ -50,6 +53,212 @@ def make_matrix(i, j):
     return m
 
 
+def log_func_array(x):
+    """
+    The transfer function g(x), applied element-wise to a NumPy array.
+
+    :param x: A NumPy array
+    :return: g(x) for every element
+    """
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def log_func_derivative_array(x):
+    """
+    The derivative g'(x), applied element-wise to a NumPy array.
+
+    :param x: A NumPy array
+    :return: g'(x) for every element
+    """
+    e = np.exp(-x)
+    return e / ((e + 1) ** 2)
+
+
+IndexedPairs = collections.namedtuple('IndexedPairs', ['features', 'higher', 'lower'])
+IndexedPairs.__doc__ = """
+Pairs given as row numbers into a feature matrix: features[higher[k]] is rated above features[lower[k]]. The matrix
+may be a read-only memory map; only the rows of one mini-batch are copied at a time.
+"""
+
+
+def pairs_to_arrays(patterns):
+    """
+    Converts a list of (a, b) feature pairs into two contiguous matrices, one row per pair. Patterns that already
+    are a tuple of two NumPy arrays are returned unchanged, so the conversion can be done once up front.
+
+    :param patterns: A list of (higher ranked features, lower ranked features) tuples
+    :return: A tuple (a, b) of float64 matrices of shape (number of pairs, number of features)
+    """
+    if isinstance(patterns, tuple) and len(patterns) == 2 and isinstance(patterns[0], np.ndarray):
+        return patterns
+
+    a = np.array([pair[0] for pair in patterns], dtype=np.float64)
+    b = np.array([pair[1] for pair in patterns], dtype=np.float64)
+
+    return a, b
+
+
+def iter_pair_batches(patterns, batch_size):
+    """
+    Splits pairs into mini-batches of matrices. Works on the output of pairs_to_arrays, on lists of pairs and on
+    streams of pairs, which are converted one batch at a time.
+
+    :param patterns: The pairs
+    :param batch_size: Maximum number of pairs per batch
+    :return: A generator of (a, b) matrix tuples
+    """
+    if isinstance(patterns, IndexedPairs):
+        for start in range(0, len(patterns.higher), batch_size):
+            yield (patterns.features[patterns.higher[start:start + batch_size]],
+                   patterns.features[patterns.lower[start:start + batch_size]])
+        return
+
+    if isinstance(patterns, tuple) and len(patterns) == 2 and isinstance(patterns[0], np.ndarray):
+        a, b = patterns
+        for start in range(0, len(a), batch_size):
+            yield a[start:start + batch_size], b[start:start + batch_size]
+        return
+
+    batch = []
+    for pair in patterns:
+        batch.append(pair)
+        if len(batch) == batch_size:
+            yield pairs_to_arrays(batch)
+            batch = []
+
+    if batch:
+        yield pairs_to_arrays(batch)
+
+
+def index_pairs_by_document(patterns):
+    """
+    Finds the unique documents of a list (or stream) of pairs, so that each can be scored once and the pairs can be
+    compared by index. Documents are told apart by identity; the pairs from generate_sorted_feature_pairs share one
+    feature list per document.
+
+    :param patterns: A list of (a, b) feature pairs
+    :return: A list of unique documents, and lists of the indices of each pair's a and b in it
+    """
+    documents = []
+    positions = {}
+    higher = []
+    lower = []
+
+    for a, b in patterns:
+        for document, indices in ((a, higher), (b, lower)):
+            position = positions.get(id(document))
+            if position is None:
+                position = positions[id(document)] = len(documents)
+                documents.append(document)
+            indices.append(position)
+
+    return documents, higher, lower
+
+
+def sample_pairs(patterns, sample_size, rng=random):
+    """
+    Draws a random sample of pairs without replacement, keeping the form of the input. Streams are sampled with a
+    reservoir, so they are read once with memory bounded by the sample size.
+
+    :param patterns: A list of pairs, the output of pairs_to_arrays, IndexedPairs, or a stream of pairs
+    :param sample_size: Number of pairs to draw. The whole set is returned if it is smaller.
+    :param rng: Source of randomness (the random module or a random.Random)
+    :return: The sampled pairs
+    """
+    if isinstance(patterns, IndexedPairs):
+        chosen = np.array(sorted(rng.sample(range(len(patterns.higher)), min(sample_size, len(patterns.higher)))),
+                          dtype=np.int64)
+        return IndexedPairs(patterns.features, patterns.higher[chosen], patterns.lower[chosen])
+
+    if isinstance(patterns, tuple) and len(patterns) == 2 and isinstance(patterns[0], np.ndarray):
+        chosen = np.array(sorted(rng.sample(range(len(patterns[0])), min(sample_size, len(patterns[0])))),
+                          dtype=np.int64)
+        return patterns[0][chosen], patterns[1][chosen]
+
+    if isinstance(patterns, list):
+        return [patterns[i] for i in sorted(rng.sample(range(len(patterns)), min(sample_size, len(patterns))))]
+
+    reservoir = []
+    for i, pair in enumerate(patterns):
+        if i < sample_size:
+            reservoir.append(pair)
+        else:
+            j = rng.randrange(i + 1)
+            if j < sample_size:
+                reservoir[j] = pair
+
+    return reservoir
+
+
+def wilson_interval(errors, trials, confidence=0.95):
+    """
+    Wilson score confidence interval for a proportion.
+
+    :param errors: Number of misordered pairs in the sample
+    :param trials: Number of pairs in the sample
+    :param confidence: Confidence level
+    :return: Lower and upper bound
+    """
+    if trials == 0:
+        return 0.0, 1.0
+
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = errors / trials
+    denominator = 1 + z ** 2 / trials
+    centre = (p + z ** 2 / (2 * trials)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / trials + z ** 2 / (4 * trials ** 2)) / denominator
+
+    return max(0.0, centre - half_width), min(1.0, centre + half_width)
+
+
+def count_misordered(higher_scores, lower_scores, tie_weight=0.0):
+    """
+    Counts the pairs where the higher rated document scores below the lower rated one.
+
+    :param higher_scores: Array with the score of the higher rated document of each pair
+    :param lower_scores: Array with the score of the lower rated document of each pair
+    :param tie_weight: How much a pair whose documents score the same counts: 0 counts it as correctly ordered, 0.5
+        as a coin flip, 1 as misordered. A network whose scores have collapsed to a constant is only caught with a
+        weight above 0.
+    :return: The number of misordered pairs (a float if tie_weight is not 0)
+    """
+    errors = np.count_nonzero(higher_scores < lower_scores)
+    if tie_weight:
+        errors += tie_weight * np.count_nonzero(higher_scores == lower_scores)
+
+    return errors
+
+
+def count_pairs_by_query(query_groups):
+    """
+    Counts the (higher, lower) rated pairs in query groups without generating them.
+
+    :param query_groups: An iterable of (features matrix, ratings array) tuples, one per query
+    :return: The number of pairs
+    """
+    pairs = 0
+
+    for _, ratings in query_groups:
+        _, counts = np.unique(ratings, return_counts=True)
+        pairs += (counts.sum() ** 2 - (counts ** 2).sum()) // 2  # Pairs of documents with different ratings
+
+    return int(pairs)
+
+
+def sort_by_rating(ratings):
+    """
+    Sorts the documents of a query by rating, so that the documents rated below any level are a prefix.
+
+    :param ratings: The documents' ratings
+    :return: The order of the documents (ascending rating), and where each rating level starts in it
+    """
+    ratings = np.asarray(ratings)
+    order = np.argsort(ratings, kind='stable')
+    sorted_ratings = ratings[order]
+
+    return order, np.searchsorted(sorted_ratings, np.unique(sorted_ratings))
+
+
 class NN:
     """
     Class holding a neural Network
@@ -57,6 +266,11 @@ class NN:
     :
     """
 
+    __slots__ = ('num_inputs', 'num_hidden', 'learning_rate',
+                 'out_i_a', 'out_i_b', 'out_h_a', 'out_h_b', 'o_a', 'o_b',
+                 'w_i_h', 'w_h_o',
+                 'delta_o_a', 'delta_o_b', 'delta_h_a', 'delta_h_b')
+
     def __init__(self, num_inputs, num_hidden, learning_rate=0.001):
         """
         Initializes a neural network. Assumes a single output node.
@@ -91,9 +305,10 @@ class NN:
             self.w_h_o[j] = random_float(-0.5, 0.5)
 
         # Data for the back-propagation step in RankNets.
-        # For storing the previous activation levels (output levels) of all neurons
-        self.out_i_a = []  # Corresponds to out_i_a
-        self.out_h_a = []  # Corresponds to out_h_a
+        # For storing the previous activation levels (output levels) of all neurons.
+        # These are the second halves of double buffers with out_i_b and out_h_b; see propagate.
+        self.out_i_a = [1.0] * self.num_inputs  # Corresponds to out_i_a
+        self.out_h_a = [1.0] * self.num_hidden  # Corresponds to out_h_a
         self.o_a = 0  # Corresponds to o_a
 
         # For storing the previous delta in the output and hidden layer
@@ -108,22 +323,27 @@ class NN:
         if len(inputs) != self.num_inputs - 1:
             raise ValueError('Wrong number of inputs')
 
-        self.out_i_a = copy.deepcopy(self.out_i_b)  # Save old input activations
+        # Save old activations by swapping the a and b buffers; the old a buffer is then overwritten with the new
+        # activations. This avoids copying or allocating lists on every call.
+        self.out_i_a, self.out_i_b = self.out_i_b, self.out_i_a
+        self.out_h_a, self.out_h_b = self.out_h_b, self.out_h_a
 
-        for i in range(self.num_inputs - 1):  # Replace by new input activations
-            self.out_i_b[i] = inputs[i]
+        out_i_b = self.out_i_b
+        out_h_b = self.out_h_b
+        w_i_h = self.w_i_h
 
-        self.out_i_b[-1] = 1  # Set bias node to -1.
+        for i in range(self.num_inputs - 1):  # Replace by new input activations
+            out_i_b[i] = inputs[i]
 
-        self.out_h_a = copy.deepcopy(self.out_h_b)  # Save hidden input activations
+        out_i_b[-1] = 1  # Set bias node to -1.
 
         for j in range(self.num_hidden):  # Calculate new activations for each hidden node
             hidden_node_sum = 0.0
 
             for i in range(self.num_inputs):
-                hidden_node_sum += self.out_i_b[i] * self.w_i_h[i][j]
+                hidden_node_sum += out_i_b[i] * w_i_h[i][j]
 
-            self.out_h_b[j] = log_func(hidden_node_sum)
+            out_h_b[j] = log_func(hidden_node_sum)
 
         self.o_a = self.o_b  # Save old output activation
 
@@ -200,7 +420,40 @@ class NN:
         print('Output weights:')
         print(self.w_h_o)
 
-    def train(self, patterns, iterations=1):
+    def score_batch(self, features_matrix):
+        """
+        Scores every row of a feature matrix without touching the network's a/b state. See VectorizedNN.score_batch.
+
+        :param features_matrix: A matrix (or list) of feature rows
+        :return: An array with one score per row
+        """
+        return VectorizedNN.from_network(self).score_batch(features_matrix)
+
+    def rank(self, query_instances):
+        """
+        Sorts query instances by descending score without touching the network's a/b state. See VectorizedNN.rank.
+
+        :param query_instances: Objects with a features attribute, e.g. the QueryInstances of one qid
+        :return: The instances in ranked order
+        """
+        return VectorizedNN.from_network(self).rank(query_instances)
+
+    def train(self, patterns, iterations=1, evaluation='pairs', sample_size=1000, evaluation_patterns=None,
+              tie_weight=0.0):
+        """
+        Trains the network on a set of pairs and returns the misordered pair ratio after each iteration.
+
+        :param patterns: A list of (a, b) feature pairs, or a re-iterable stream of pairs
+        :param iterations: Number of passes over the pairs
+        :param evaluation: How the ratio is found; see count_misordered_pairs
+        :param sample_size: Sample size for evaluation='sample'
+        :param evaluation_patterns: The pairs to find the ratio on, e.g. a fixed sample of patterns drawn once with
+            sample_pairs. Defaults to patterns.
+        :param tie_weight: How much pairs with equal scores count as misordered; see count_misordered
+        :return: A list with the error ratio after each iteration
+        """
+        if evaluation_patterns is None:
+            evaluation_patterns = patterns
 
         error_rates = list()
 
@@ -210,17 +463,471 @@ class NN:
                 self.propagate(b)
                 self.back_propagate()
 
-            error_rates.append(self.count_misordered_pairs(patterns))
+            error_rates.append(self.count_misordered_pairs(evaluation_patterns, evaluation, sample_size,
+                                                           tie_weight=tie_weight))
 
         return error_rates
 
-    def count_misordered_pairs(self, patterns):
+    def count_misordered_pairs(self, patterns, evaluation='pairs', sample_size=1000, rng=random, tie_weight=0.0):
+        """
+        Finds the ratio of pairs where the lower rated item gets the higher output.
+
+        :param patterns: A list of (a, b) feature pairs, or a stream of pairs
+        :param evaluation: 'pairs' propagates both items of every pair. 'documents' propagates each unique document
+            once and compares the pairs by index, which is exact and about half the work on data where documents
+            are in many pairs. 'sample' evaluates a random sample of pairs (see estimate_misordered_pairs).
+        :param sample_size: Sample size for evaluation='sample'
+        :param rng: Source of randomness for evaluation='sample'
+        :param tie_weight: How much pairs with equal scores count as misordered; see count_misordered
+        :return: The ratio of misordered pairs
+        """
+        if evaluation == 'documents':
+            documents, higher, lower = index_pairs_by_document(patterns)
+            scores = [self.propagate(document) for document in documents]
+            errors = sum(1 if scores[h] < scores[l] else tie_weight if scores[h] == scores[l] else 0
+                         for h, l in zip(higher, lower))
+            return errors / len(higher)
+
+        if evaluation == 'sample':
+            return self.estimate_misordered_pairs(patterns, sample_size, rng=rng, tie_weight=tie_weight)[0]
+
+        if evaluation != 'pairs':
+            raise ValueError('Unknown evaluation: ' + str(evaluation))
+
         errors = 0
+        pairs = 0  # Counted as we go, so that patterns can be a stream
 
         for a, b in patterns:
             result_a = self.propagate(a)
             result_b = self.propagate(b)
             if result_a < result_b:
                 errors += 1
+            elif result_a == result_b:
+                errors += tie_weight
+            pairs += 1
+
+        return errors / pairs
+
+    def estimate_misordered_pairs(self, patterns, sample_size=1000, confidence=0.95, rng=random, tie_weight=0.0):
+        """
+        Estimates the ratio of misordered pairs from a random sample of pairs.
+
+        :param patterns: A list of (a, b) feature pairs, or a stream of pairs
+        :param sample_size: Number of pairs to evaluate
+        :param confidence: Confidence level of the interval
+        :param rng: Source of randomness (the random module or a random.Random)
+        :param tie_weight: How much pairs with equal scores count as misordered; see count_misordered
+        :return: The estimated ratio, and the lower and upper bound of its Wilson confidence interval
+        """
+        sample = sample_pairs(patterns, sample_size, rng)
+        ratio = self.count_misordered_pairs(sample, 'documents', tie_weight=tie_weight)
+        low, high = wilson_interval(round(ratio * len(sample)), len(sample), confidence)
+
+        return ratio, low, high
+
+
+class VectorizedNN:
+    """
+    NumPy-backed RankNet network with the same topology and update rule as NN. The weights are kept in contiguous
+    arrays, and the forward and backward passes run over whole mini-batches of (a, b) pairs as matrix products.
+
+    With batch_size=1 the updates are identical to NN.train. Larger batches sum the per-pair updates of the batch
+    before applying them, which trades a little of the stochasticity of plain SGD for far fewer Python calls.
+    """
+
+    def __init__(self, num_inputs, num_hidden, learning_rate=0.001):
+        """
+        Initializes a vectorized neural network. Assumes a single output node.
+
+        The weights are drawn in the same order as in NN, so seeding the random module gives both networks the
+        same starting point.
+
+        :param num_inputs: Number of input nodes.
+        :param num_hidden: Number of hidden nodes.
+        :param learning_rate: The learning rate.
+        """
+
+        self.num_inputs = num_inputs + 1  # Add a bias node, as in NN
+        self.num_hidden = num_hidden
+        self.learning_rate = learning_rate
+
+        w_i_h = make_matrix(self.num_inputs, self.num_hidden)
+
+        for i in range(self.num_inputs):
+            for j in range(self.num_hidden):
+                w_i_h[i][j] = random_float(-0.5, 0.5)
 
-        return errors / len(patterns)
+        w_h_o = [random_float(-0.5, 0.5) for _ in range(self.num_hidden)]
+
+        self.w_i_h = np.array(w_i_h, dtype=np.float64)  # Shape (num_inputs, num_hidden)
+        self.w_h_o = np.array(w_h_o, dtype=np.float64)  # Shape (num_hidden,)
+
+    @classmethod
+    def from_weights(cls, w_i_h, w_h_o, learning_rate=0.001):
+        """
+        Creates a network from existing weights. The input weights include the bias row.
+
+        :param w_i_h: Input to hidden weights, shape (num_inputs + 1, num_hidden)
+        :param w_h_o: Hidden to output weights, shape (num_hidden,)
+        :param learning_rate: The learning rate.
+        :return: A VectorizedNN with copies of the given weights
+        """
+        nn = cls.__new__(cls)
+        nn.w_i_h = np.array(w_i_h, dtype=np.float64)
+        nn.w_h_o = np.array(w_h_o, dtype=np.float64)
+        nn.num_inputs, nn.num_hidden = nn.w_i_h.shape
+        nn.learning_rate = learning_rate
+
+        return nn
+
+    @classmethod
+    def from_network(cls, nn):
+        """
+        Creates a vectorized copy of a list-based NN.
+
+        :param nn: An NN
+        :return: A VectorizedNN with the same weights
+        """
+        return cls.from_weights(nn.w_i_h, nn.w_h_o, nn.learning_rate)
+
+    def freeze(self):
+        """
+        Returns a read-only copy of the network for serving. Its weight arrays cannot be written to, so training
+        this network afterwards does not affect the copy, and the copy can be scored from several threads at once.
+
+        :return: A frozen VectorizedNN
+        """
+        frozen = VectorizedNN.from_weights(self.w_i_h, self.w_h_o, self.learning_rate)
+        frozen.w_i_h.flags.writeable = False
+        frozen.w_h_o.flags.writeable = False
+
+        return frozen
+
+    def add_bias(self, inputs):
+        """
+        Appends the constant bias input to a matrix of feature rows.
+
+        :param inputs: Matrix of shape (n, num_inputs - 1)
+        :return: Matrix of shape (n, num_inputs)
+        """
+        inputs = np.asarray(inputs, dtype=np.float64)
+
+        if inputs.ndim != 2 or inputs.shape[1] != self.num_inputs - 1:
+            raise ValueError('Wrong number of inputs')
+
+        with_bias = np.empty((inputs.shape[0], self.num_inputs))
+        with_bias[:, :-1] = inputs
+        with_bias[:, -1] = 1.0
+
+        return with_bias
+
+    def forward(self, inputs_with_bias):
+        """
+        Propagates a batch of rows (including the bias column) through the network.
+
+        :param inputs_with_bias: Matrix of shape (n, num_inputs)
+        :return: Hidden activations of shape (n, num_hidden) and output activations of shape (n,)
+        """
+        hidden = log_func_array(inputs_with_bias @ self.w_i_h)
+        output = log_func_array(hidden @ self.w_h_o)
+
+        return hidden, output
+
+    def propagate(self, inputs):
+        """
+        Computes the output activation for one feature vector, or for every row of a feature matrix.
+
+        :param inputs: A feature vector or a matrix of feature rows
+        :return: The output activation (a float for a vector, an array for a matrix)
+        """
+        inputs = np.asarray(inputs, dtype=np.float64)
+
+        if inputs.ndim == 1:
+            return float(self.score_batch(inputs[np.newaxis, :])[0])
+
+        return self.score_batch(inputs)
+
+    def score_batch(self, features_matrix):
+        """
+        Scores every row of a feature matrix in one vectorized call. Only reads the weights, so on a frozen network
+        (see freeze) it is safe to call from several threads at once.
+
+        :param features_matrix: A matrix (or list) of feature rows, e.g. every document of one qid
+        :return: An array with one score per row
+        """
+        return self.forward(self.add_bias(features_matrix))[1]
+
+    def score_rows(self, features_matrix, chunk_size=65536):
+        """
+        Scores a possibly very large (e.g. memory-mapped) feature matrix a chunk of rows at a time, so that only one
+        chunk is converted in memory at once.
+
+        :param features_matrix: A matrix of feature rows
+        :param chunk_size: Rows per chunk
+        :return: An array with one score per row
+        """
+        scores = np.empty(len(features_matrix))
+
+        for start in range(0, len(features_matrix), chunk_size):
+            scores[start:start + chunk_size] = self.score_batch(features_matrix[start:start + chunk_size])
+
+        return scores
+
+    def rank(self, query_instances):
+        """
+        Scores all query instances in one call and sorts them by descending score. Instances with equal scores keep
+        their original order.
+
+        :param query_instances: Objects with a features attribute, e.g. the QueryInstances of one qid
+        :return: The instances in ranked order
+        """
+        if len(query_instances) == 0:
+            return []
+
+        scores = self.score_batch([instance.features for instance in query_instances])
+        order = np.argsort(-scores, kind='stable')
+
+        return [query_instances[i] for i in order]
+
+    def back_propagate(self, in_a, in_b):
+        """
+        Does one RankNet update from a mini-batch of pairs, where each row of in_a is rated higher than the same row
+        of in_b. Follows NN.compute_output_delta, NN.compute_hidden_delta and NN.update_weights.
+
+        :param in_a: Matrix of higher rated rows, including the bias column
+        :param in_b: Matrix of lower rated rows, including the bias column
+        """
+        h_a, o_a = self.forward(in_a)
+        h_b, o_b = self.forward(in_b)
+
+        p_ab = 1 / (1 + np.exp(o_b - o_a))
+
+        delta_o_a = log_func_derivative_array(o_a) * (1 - p_ab)
+        delta_o_b = log_func_derivative_array(o_b) * (1 - p_ab)
+
+        delta_diff = (delta_o_a - delta_o_b)[:, np.newaxis] * self.w_h_o
+        delta_h_a = log_func_derivative_array(h_a) * delta_diff
+        delta_h_b = log_func_derivative_array(h_b) * delta_diff
+
+        self.w_i_h += self.learning_rate * (in_a.T @ delta_h_a - in_b.T @ delta_h_b)
+        self.w_h_o += self.learning_rate * (delta_o_a @ h_a - delta_o_b @ h_b)
+
+    def weights(self):
+        """Prints the network weights.
+
+        :return:
+        """
+        print('Input weights:')
+        print(self.w_i_h)
+        print()
+        print('Output weights:')
+        print(self.w_h_o)
+
+    def train(self, patterns, iterations=1, batch_size=32, evaluation='pairs', sample_size=1000,
+              evaluation_patterns=None, tie_weight=0.0):
+        """
+        Trains the network on a set of pairs and returns the misordered pair ratio after each iteration.
+
+        :param patterns: A list of (a, b) feature pairs, the output of pairs_to_arrays, IndexedPairs, or a re-iterable
+            stream of pairs (see data_loader_skeleton.PairStream)
+        :param iterations: Number of passes over the pairs
+        :param batch_size: Number of pairs per weight update
+        :param evaluation: How the ratio is found; see count_misordered_pairs
+        :param sample_size: Sample size for evaluation='sample'
+        :param evaluation_patterns: The pairs to find the ratio on, e.g. a fixed sample of patterns drawn once with
+            sample_pairs. Defaults to patterns.
+        :param tie_weight: How much pairs with equal scores count as misordered; see count_misordered
+        :return: A list with the error ratio after each iteration
+        """
+        if isinstance(patterns, list):
+            patterns = pairs_to_arrays(patterns)  # Convert once rather than once per iteration
+        if evaluation_patterns is None:
+            evaluation_patterns = patterns
+
+        error_rates = list()
+
+        for i in range(iterations):
+            for a, b in iter_pair_batches(patterns, batch_size):
+                self.back_propagate(self.add_bias(a), self.add_bias(b))
+
+            error_rates.append(self.count_misordered_pairs(evaluation_patterns, evaluation, sample_size,
+                                                           tie_weight=tie_weight))
+
+        return error_rates
+
+    def count_misordered_pairs(self, patterns, evaluation='pairs', sample_size=1000, rng=random, tie_weight=0.0):
+        """
+        Finds the ratio of pairs where the lower rated item gets the higher output.
+
+        :param patterns: A list of (a, b) feature pairs, the output of pairs_to_arrays, IndexedPairs, or a stream of
+            pairs
+        :param evaluation: 'pairs' scores both items of every pair. 'documents' scores each unique document once and
+            compares the pairs by index; IndexedPairs are always evaluated this way, and pairs_to_arrays output never
+            is, since its rows have lost their identity. 'sample' evaluates a random sample of pairs (see
+            estimate_misordered_pairs).
+        :param sample_size: Sample size for evaluation='sample'
+        :param rng: Source of randomness for evaluation='sample'
+        :param tie_weight: How much pairs with equal scores count as misordered; see count_misordered
+        :return: The ratio of misordered pairs
+        """
+        if evaluation == 'sample':
+            return self.estimate_misordered_pairs(patterns, sample_size, rng=rng, tie_weight=tie_weight)[0]
+
+        if evaluation not in ('pairs', 'documents'):
+            raise ValueError('Unknown evaluation: ' + str(evaluation))
+
+        if isinstance(patterns, IndexedPairs):
+            rows = np.concatenate([patterns.higher, patterns.lower])
+            if len(rows) < len(patterns.features) // 2:
+                # Few pairs, e.g. a sample: only score the rows they use
+                rows, positions = np.unique(rows, return_inverse=True)
+                scores = self.score_batch(patterns.features[rows])[positions]
+                higher_scores, lower_scores = np.split(scores, 2)
+            else:
+                # Score every row once and compare the pairs by row number
+                scores = self.score_rows(patterns.features)
+                higher_scores, lower_scores = scores[patterns.higher], scores[patterns.lower]
+            return float(count_misordered(higher_scores, lower_scores, tie_weight)) / len(patterns.higher)
+
+        if evaluation == 'documents' and not isinstance(patterns, tuple):
+            documents, higher, lower = index_pairs_by_document(patterns)
+            scores = self.score_batch(documents)
+            return float(count_misordered(scores[higher], scores[lower], tie_weight)) / len(higher)
+
+        errors = 0
+        pairs = 0
+
+        for a, b in iter_pair_batches(patterns, 4096):
+            errors += count_misordered(self.score_batch(a), self.score_batch(b), tie_weight)
+            pairs += len(a)
+
+        return float(errors) / pairs
+
+    def estimate_misordered_pairs(self, patterns, sample_size=1000, confidence=0.95, rng=random, tie_weight=0.0):
+        """
+        Estimates the ratio of misordered pairs from a random sample of pairs.
+
+        :param patterns: A list of (a, b) feature pairs, the output of pairs_to_arrays, IndexedPairs, or a stream of
+            pairs
+        :param sample_size: Number of pairs to evaluate
+        :param confidence: Confidence level of the interval
+        :param rng: Source of randomness (the random module or a random.Random)
+        :param tie_weight: How much pairs with equal scores count as misordered; see count_misordered
+        :return: The estimated ratio, and the lower and upper bound of its Wilson confidence interval
+        """
+        sample = sample_pairs(patterns, sample_size, rng)
+        if isinstance(sample, list):
+            sample = pairs_to_arrays(sample)
+        ratio = self.count_misordered_pairs(sample, 'documents', tie_weight=tie_weight)
+        size = len(sample.higher) if isinstance(sample, IndexedPairs) else len(sample[0])
+        low, high = wilson_interval(round(ratio * size), size, confidence)
+
+        return ratio, low, high
+
+    def train_factorized(self, query_groups, iterations=1, tie_weight=0.0):
+        """
+        Trains the network one query at a time without materializing the pairs. Every document of a query is
+        propagated once, and the RankNet updates of all pairs within the query are accumulated from those cached
+        activations (the factorization used by LambdaRank). One update is made per query.
+
+        :param query_groups: An iterable of (features matrix, ratings array) tuples, one per query
+        :param iterations: Number of passes over the queries
+        :param tie_weight: How much pairs with equal scores count as misordered; see count_misordered
+        :return: A list with the error ratio after each iteration
+        """
+        error_rates = list()
+
+        for i in range(iterations):
+            for features, ratings in query_groups:
+                self.back_propagate_query(self.add_bias(features), np.asarray(ratings))
+
+            error_rates.append(self.count_misordered_pairs_by_query(query_groups, tie_weight))
+
+        return error_rates
+
+    def back_propagate_query(self, inputs_with_bias, ratings, chunk_pairs=262144):
+        """
+        Does one RankNet update from all pairs of documents within a query. Gives the same update as back_propagate
+        on a batch holding every pair of the query, but with one forward pass per document instead of per pair.
+
+        The pair terms are summed into four numbers per document, as the higher and as the lower rated document of
+        its pairs. The documents are sorted by rating, so the ones rated below a level are a prefix; each level is
+        paired with that prefix a chunk of rows at a time, so documents with equal ratings are never paired and at
+        most chunk_pairs pair terms are held at once.
+
+        :param inputs_with_bias: Matrix of the query's documents, including the bias column
+        :param ratings: The documents' ratings
+        :param chunk_pairs: Number of pairs per chunk
+        """
+        order, starts = sort_by_rating(ratings)
+
+        if len(starts) < 2:
+            return
+
+        hidden, output = self.forward(inputs_with_bias)
+        derivative = log_func_derivative_array(output)
+        o, d = output[order], derivative[order]
+
+        # For document k: sums over its pairs (k, j) as a, and (i, k) as b, of 1 - p_ab and of it times g'(o) of
+        # the other document
+        row_sums = np.zeros(len(o))
+        row_derivative_sums = np.zeros(len(o))
+        column_sums = np.zeros(len(o))
+        column_derivative_sums = np.zeros(len(o))
+
+        ends = list(starts[2:]) + [len(o)]
+        for lower, end in zip(starts[1:], ends):  # Documents [lower, end) are rated above documents [0, lower)
+            rows_per_chunk = max(1, chunk_pairs // lower)
+            for first in range(lower, end, rows_per_chunk):
+                rows = slice(first, min(first + rows_per_chunk, end))
+                one_minus_p_ab = 1 / (1 + np.exp(o[rows, np.newaxis] - o[np.newaxis, :lower]))
+
+                row_sums[rows] += one_minus_p_ab.sum(axis=1)
+                row_derivative_sums[rows] += one_minus_p_ab @ d[:lower]
+                column_sums[:lower] += one_minus_p_ab.sum(axis=0)
+                column_derivative_sums[:lower] += d[rows] @ one_minus_p_ab
+
+        # Positive where the document is a, negative where it is b; back in the order of the documents
+        output_coefficients = np.empty(len(o))
+        hidden_coefficients = np.empty(len(o))
+        output_coefficients[order] = d * (row_sums - column_sums)
+        hidden_coefficients[order] = d * (row_sums + column_sums) - row_derivative_sums - column_derivative_sums
+
+        delta_h = log_func_derivative_array(hidden) * self.w_h_o * hidden_coefficients[:, np.newaxis]
+
+        self.w_i_h += self.learning_rate * (inputs_with_bias.T @ delta_h)
+        self.w_h_o += self.learning_rate * (output_coefficients @ hidden)
+
+    def count_misordered_pairs_by_query(self, query_groups, tie_weight=0.0):
+        """
+        Finds the ratio of misordered pairs in query groups. Every document is scored once, and each rating level of
+        a query is compared with the sorted scores of the documents rated below it, so a query costs O(n log n) time
+        per level and O(n) memory.
+
+        :param query_groups: An iterable of (features matrix, ratings array) tuples, one per query
+        :param tie_weight: How much pairs with equal scores count as misordered; see count_misordered
+        :return: The ratio of misordered pairs
+        :raise ValueError: If no query has documents with different ratings
+        """
+        errors = 0
+        pairs = 0
+
+        for features, ratings in query_groups:
+            order, starts = sort_by_rating(ratings)
+            scores = self.score_batch(features)[order]
+
+            ends = list(starts[2:]) + [len(scores)]
+            for lower, end in zip(starts[1:], ends):
+                lower_scores = np.sort(scores[:lower])
+                # For each document of the level, the lower rated documents that do not score above it
+                not_above = np.searchsorted(lower_scores, scores[lower:end], side='right')
+                errors += int(lower * (end - lower) - not_above.sum())
+                if tie_weight:
+                    below = np.searchsorted(lower_scores, scores[lower:end], side='left')
+                    errors += tie_weight * int((not_above - below).sum())
+                pairs += lower * (end - lower)
+
+        if pairs == 0:
+            raise ValueError('No pairs to compare: every query has documents of only one rating')
+
+        return float(errors) / int(pairs)
@@ -0,0 +1,153 @@
+"""
+Micro-benchmarks for the RankNet implementation in this directory.
+
+Run from the ex05 directory: python benchmarks.py
+"""
+
+import copy
+import multiprocessing
+import random
+import resource
+import time
+
+import Backprop_skeleton as bp
+import data_loader_skeleton as dl
+
+
+def legacy_propagate(nn, inputs):
+    """The original NN.propagate, which saved the previous activations with copy.deepcopy on every call.
+    Kept here as the baseline for benchmark_propagate.
+
+    :param nn: An NN
+    :param inputs: A feature vector
+    :return: The output activation
+    """
+    nn.out_i_a = copy.deepcopy(nn.out_i_b)
+
+    for i in range(nn.num_inputs - 1):
+        nn.out_i_b[i] = inputs[i]
+
+    nn.out_i_b[-1] = 1
+
+    nn.out_h_a = copy.deepcopy(nn.out_h_b)
+
+    for j in range(nn.num_hidden):
+        hidden_node_sum = 0.0
+
+        for i in range(nn.num_inputs):
+            hidden_node_sum += nn.out_i_b[i] * nn.w_i_h[i][j]
+
+        nn.out_h_b[j] = bp.log_func(hidden_node_sum)
+
+    nn.o_a = nn.o_b
+
+    output_node_sum = 0.0
+
+    for j in range(nn.num_hidden):
+        output_node_sum += nn.out_h_b[j] * nn.w_h_o[j]
+
+    nn.o_b = bp.log_func(output_node_sum)
+
+    return nn.o_b
+
+
+def time_per_pair(step, pairs):
+    """Times a function called once per pair.
+
+    :param step: Function taking the two feature vectors of a pair
+    :param pairs: The pairs
+    :return: Seconds per pair
+    """
+    start = time.perf_counter()
+    for a, b in pairs:
+        step(a, b)
+
+    return (time.perf_counter() - start) / len(pairs)
+
+
+def benchmark_propagate(training_set="data_sets/train.txt", number_of_pairs=2000):
+    """Prints the per-pair cost of propagating a RankNet pair (and of a full training step) with the deepcopy
+    based propagate and with the double-buffered one.
+
+    :param training_set: File path to training set
+    :param number_of_pairs: Number of pairs to time
+    """
+    pairs = dl.generate_sorted_feature_pairs(dl.load_query_dict_from_file(training_set))[:number_of_pairs]
+
+    random.seed(0)
+    nn = bp.NN(46, 10)
+
+    def legacy_pair(a, b):
+        legacy_propagate(nn, a)
+        legacy_propagate(nn, b)
+
+    def buffered_pair(a, b):
+        nn.propagate(a)
+        nn.propagate(b)
+
+    def legacy_train_step(a, b):
+        legacy_pair(a, b)
+        nn.back_propagate()
+
+    def buffered_train_step(a, b):
+        buffered_pair(a, b)
+        nn.back_propagate()
+
+    print("Per-pair cost over %d pairs (microseconds)" % len(pairs))
+    print("\tPropagate, deepcopy:         %8.1f" % (time_per_pair(legacy_pair, pairs) * 1e6))
+    print("\tPropagate, double-buffered:  %8.1f" % (time_per_pair(buffered_pair, pairs) * 1e6))
+    print("\tTrain step, deepcopy:        %8.1f" % (time_per_pair(legacy_train_step, pairs) * 1e6))
+    print("\tTrain step, double-buffered: %8.1f" % (time_per_pair(buffered_train_step, pairs) * 1e6))
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in megabytes (Linux reports ru_maxrss in kilobytes).
+
+    :return: Peak RSS in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _time_pair_epoch(training_set, stream, batch_size):
+    """Loads the training pairs (or opens a stream of them), trains a VectorizedNN for one epoch, and reports the
+    throughput and peak RSS. Meant to run in a fresh process so that the peak RSS belongs to this case only.
+
+    :return: Number of pairs, pairs per second, peak RSS in MB
+    """
+    random.seed(0)
+    nn = bp.VectorizedNN(46, 10)
+
+    start = time.perf_counter()
+    if stream:
+        pairs = dl.PairStream(training_set, buffer_size=10000, seed=0)
+    else:
+        pairs = dl.generate_sorted_feature_pairs(dl.load_query_dict_from_file(training_set))
+
+    number_of_pairs = 0
+    for a, b in bp.iter_pair_batches(pairs, 32):
+        nn.back_propagate(nn.add_bias(a), nn.add_bias(b))
+        number_of_pairs += len(a)
+    elapsed = time.perf_counter() - start
+
+    return number_of_pairs, number_of_pairs / elapsed, peak_rss_mb()
+
+
+def benchmark_pair_streaming(training_set="data_sets/train.txt"):
+    """Prints pairs per second and peak RSS for one training epoch (including loading) with the in-memory pair list
+    and with the streamed, shuffle-buffered pairs. Each case runs in its own process.
+
+    :param training_set: File path to training set
+    """
+    context = multiprocessing.get_context('spawn')
+
+    print("One epoch over %s, including loading" % training_set)
+    for stream in (False, True):
+        with context.Pool(1) as pool:
+            number_of_pairs, pairs_per_second, rss = pool.apply(_time_pair_epoch, (training_set, stream, 32))
+        print("\t%-10s %8d pairs %10.0f pairs/s %8.1f MB peak RSS"
+              % ('Streamed' if stream else 'In memory', number_of_pairs, pairs_per_second, rss))
+
+
+if __name__ == '__main__':
+    benchmark_propagate()
+    benchmark_pair_streaming()
@@ -1,8 +1,16 @@
+import collections
+import concurrent.futures
+import functools
+import io
+import json
+import os
+import random
 import time
 
 import matplotlib.pyplot as plt
+import numpy as np
 
-import backprop_skeleton as bp
+import Backprop_skeleton as bp
 
 
 class QueryInstance:
@@ -20,6 +28,25 @@ class QueryInstance:
                + ". features: " + str(self.features)
 
 
+def parse_query_instance(line):
+    """Parses one line of a data file into a QueryInstance.
+
+    :param line: A line of the form "rating qid:id 1:value 2:value ... #docid = ..."
+    :return: The QueryInstance
+    """
+    # Fields of query given by position
+    instance_data = line.split()
+    instance_rating = int(instance_data[0])
+    qid = int(instance_data[1].split(':')[1])
+    instance_features = []
+    for elem in instance_data[2:]:
+        if '#docid' in elem:  # Reached a comment. Line done.
+            break
+        instance_features.append(float(elem.split(':')[1]))
+
+    return QueryInstance(qid, instance_rating, instance_features)
+
+
 def load_query_dict_from_file(file_path):
     """Loads queries from a file and returns a dict mapping each query ID to a list of relevant QueryInstances.
 
@@ -30,18 +57,8 @@ def load_query_dict_from_file(file_path):
     queries_file = open(file_path)
     query_dict = {}
     for line in queries_file:
-        # Fields of query given by position
-        instance_data = line.split()
-        instance_rating = int(instance_data[0])
-        qid = int(instance_data[1].split(':')[1])
-        instance_features = []
-        for elem in instance_data[2:]:
-            if '#docid' in elem:  # Reached a comment. Line done.
-                break
-            instance_features.append(float(elem.split(':')[1]))
-
-        q_inst = QueryInstance(qid, instance_rating,
-                               instance_features)  # Creating a new query instance, inserting in the dict.
+        q_inst = parse_query_instance(line)  # Creating a new query instance, inserting in the dict.
+        qid = q_inst.qid
         if qid in query_dict:
             query_dict[qid].append(q_inst)
         else:
@@ -50,6 +67,334 @@ def load_query_dict_from_file(file_path):
     return query_dict
 
 
+LetorData = collections.namedtuple('LetorData', ['ratings', 'qids', 'features', 'query_offsets', 'comments'])
+LetorData.__doc__ = """
+Columnar form of a LETOR/SVMlight data file. The rows of each query ID are consecutive, in order of first appearance,
+and the rows of query k are query_offsets[k]:query_offsets[k + 1]. comments holds the text after '#' on each line
+(the docid tail), or is None when it was not requested.
+"""
+
+LETOR_COLUMNS = ('ratings', 'qids', 'features', 'query_offsets')
+
+
+def parse_letor_file(file_path, keep_comments=False):
+    """Parses a LETOR/SVMlight file straight into NumPy arrays, without creating a QueryInstance per line. All
+    feature values of the file are converted to numbers in a single call. Sparse lines (missing feature indices)
+    get zeros.
+
+    :param file_path: A file with the data.
+    :param keep_comments: Whether to keep the '#docid ...' tail of each line.
+    :return: A LetorData
+    """
+    with open(file_path) as queries_file:
+        lines = [line.partition('#') for line in queries_file]
+
+    # Every line is "rating qid:id index:value ...", so it holds twice as many numbers as it has colons
+    lines = [(data, comment) for data, _, comment in lines if ':' in data]
+    data_text = '\n'.join([data for data, _ in lines]).replace('qid:', ' ').replace(':', ' ')
+    numbers_per_line = 2 * np.array([data.count(':') for data, _ in lines], dtype=np.int64)
+
+    if len(lines) and np.all(numbers_per_line == numbers_per_line[0]):
+        numbers = np.loadtxt(io.StringIO(data_text), ndmin=2).ravel()  # Dense file: NumPy's fast C reader
+    else:
+        numbers = np.fromstring(data_text, sep=' ')
+
+    if len(numbers) != numbers_per_line.sum():
+        raise ValueError('Could not parse ' + file_path)
+
+    line_starts = np.cumsum(numbers_per_line) - numbers_per_line
+    ratings = numbers[line_starts].astype(np.int64)
+    qids = numbers[line_starts + 1].astype(np.int64)
+
+    is_feature = np.ones(len(numbers), dtype=bool)
+    is_feature[line_starts] = False
+    is_feature[line_starts + 1] = False
+    index_value_pairs = numbers[is_feature].reshape(-1, 2)
+
+    columns = index_value_pairs[:, 0].astype(np.int64) - 1
+    rows = np.repeat(np.arange(len(lines)), numbers_per_line // 2 - 1)
+
+    features = np.zeros((len(lines), columns.max() + 1 if len(columns) else 0), dtype=np.float32)
+    features[rows, columns] = index_value_pairs[:, 1]
+
+    comments = np.array([comment.strip() for _, comment in lines]) if keep_comments else None
+
+    # Make the rows of each query consecutive, ordering the queries by first appearance like load_query_dict_from_file
+    unique_qids, first_rows, inverse = np.unique(qids, return_index=True, return_inverse=True)
+    query_rank = np.empty(len(unique_qids), dtype=np.int64)
+    query_rank[np.argsort(first_rows)] = np.arange(len(unique_qids))
+    row_query = query_rank[inverse]
+
+    if np.any(np.diff(row_query) < 0):
+        order = np.argsort(row_query, kind='stable')
+        ratings, qids, features, row_query = ratings[order], qids[order], features[order], row_query[order]
+        if keep_comments:
+            comments = comments[order]
+
+    query_offsets = np.searchsorted(row_query, np.arange(len(unique_qids) + 1))
+
+    return LetorData(ratings, qids, features, query_offsets, comments)
+
+
+def letor_cache_dir(file_path):
+    """The default directory of the binary cache of a data file.
+
+    :param file_path: A file with the data.
+    :return: The cache directory path
+    """
+    return file_path + '.cache'
+
+
+def _source_key(file_path):
+    """Identifies the current version of a data file by its size and modification time.
+
+    :param file_path: A file with the data.
+    :return: A dict that is stored with the cache
+    """
+    status = os.stat(file_path)
+    return {'size': status.st_size, 'mtime_ns': status.st_mtime_ns}
+
+
+def _replace_atomically(path, write):
+    """Writes a file under a temporary name and then moves it into place, so readers never see half a file.
+
+    :param path: The final path
+    :param write: Function writing to an open binary file
+    """
+    temporary_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary_path, 'wb') as f:
+        write(f)
+    os.replace(temporary_path, path)
+
+
+def write_letor_cache(data, file_path, cache_dir=None):
+    """Writes parsed data to a binary cache: one .npy file per column and a source.json holding the key of the
+    source file. source.json is written last, so an interrupted write leaves an invalid cache rather than a wrong one.
+
+    :param data: A LetorData
+    :param file_path: The data file that was parsed
+    :param cache_dir: The cache directory. Defaults to letor_cache_dir(file_path).
+    """
+    cache_dir = cache_dir or letor_cache_dir(file_path)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    key_path = os.path.join(cache_dir, 'source.json')
+    if os.path.exists(key_path):
+        os.remove(key_path)
+
+    columns = LETOR_COLUMNS + (('comments',) if data.comments is not None else ())
+    for column in columns:
+        _replace_atomically(os.path.join(cache_dir, column + '.npy'),
+                            lambda f: np.save(f, getattr(data, column), allow_pickle=False))
+
+    key = dict(_source_key(file_path), comments=data.comments is not None)
+    _replace_atomically(key_path, lambda f: f.write(json.dumps(key).encode()))
+
+
+def read_letor_cache(file_path, cache_dir=None, keep_comments=False, mmap_mode=None):
+    """Reads the binary cache of a data file if it is up to date.
+
+    :param file_path: The data file
+    :param cache_dir: The cache directory. Defaults to letor_cache_dir(file_path).
+    :param keep_comments: Whether the comments column is needed
+    :param mmap_mode: Passed to numpy.load, e.g. 'r' to memory-map the columns
+    :return: A LetorData, or None if the cache is missing, stale or lacks the comments
+    """
+    cache_dir = cache_dir or letor_cache_dir(file_path)
+
+    try:
+        with open(os.path.join(cache_dir, 'source.json')) as f:
+            key = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    source_key = _source_key(file_path)
+    if key.get('size') != source_key['size'] or key.get('mtime_ns') != source_key['mtime_ns']:
+        return None
+
+    if keep_comments and not key.get('comments'):
+        return None
+
+    columns = [np.load(os.path.join(cache_dir, column + '.npy'), mmap_mode=mmap_mode) for column in LETOR_COLUMNS]
+    comments = np.load(os.path.join(cache_dir, 'comments.npy')) if keep_comments else None
+
+    return LetorData(*columns, comments=comments)
+
+
+def load_letor_arrays(file_path, keep_comments=False, use_cache=True, cache_dir=None):
+    """Loads a data file as NumPy arrays. The parsed columns are cached on disk next to the file, keyed on the file's
+    size and modification time, so repeated loads only read the binary arrays.
+
+    :param file_path: A file with the data.
+    :param keep_comments: Whether to keep the '#docid ...' tail of each line.
+    :param use_cache: Whether to read and write the binary cache.
+    :param cache_dir: The cache directory. Defaults to letor_cache_dir(file_path).
+    :return: A LetorData
+    """
+    if use_cache:
+        data = read_letor_cache(file_path, cache_dir, keep_comments)
+        if data is not None:
+            return data
+
+    data = parse_letor_file(file_path, keep_comments)
+
+    if use_cache:
+        write_letor_cache(data, file_path, cache_dir)
+
+    return data
+
+
+def open_feature_store(file_path, cache_dir=None):
+    """Opens the binary cache of a data file as a read-only memory map, building the cache first if needed. Rows and
+    query slices of the returned columns are views into the mapped file, and processes that open the same store share
+    the same pages of the page cache.
+
+    :param file_path: A file with the data.
+    :param cache_dir: The cache directory. Defaults to letor_cache_dir(file_path).
+    :return: A LetorData with memory-mapped columns
+    """
+    data = read_letor_cache(file_path, cache_dir, mmap_mode='r')
+
+    if data is None:
+        write_letor_cache(parse_letor_file(file_path), file_path, cache_dir)
+        data = read_letor_cache(file_path, cache_dir, mmap_mode='r')
+
+    return data
+
+
+def generate_sorted_index_pairs(data):
+    """The pairs of generate_sorted_feature_pairs, in the same order, as row numbers into the feature matrix of
+    columnar data rather than as feature lists.
+
+    :param data: A LetorData, e.g. from open_feature_store
+    :return: An IndexedPairs over data.features
+    """
+    higher = []
+    lower = []
+    offsets = data.query_offsets
+
+    for k in range(len(offsets) - 1):
+        start, end = offsets[k], offsets[k + 1]
+        ratings = np.asarray(data.ratings[start:end])
+        rows_by_rating = [start + np.flatnonzero(ratings == value) for value in np.unique(ratings)[::-1]]
+
+        for i in range(len(rows_by_rating) - 1):
+            for j in range(i + 1, len(rows_by_rating)):
+                higher.append(np.repeat(rows_by_rating[i], len(rows_by_rating[j])))
+                lower.append(np.tile(rows_by_rating[j], len(rows_by_rating[i])))
+
+    empty = np.zeros(0, dtype=np.int64)
+
+    return bp.IndexedPairs(data.features, np.concatenate(higher or [empty]), np.concatenate(lower or [empty]))
+
+
+def query_dict_from_letor(data):
+    """Builds the query dict of load_query_dict_from_file from columnar data.
+
+    :param data: A LetorData
+    :return: A dict mapping query IDs to relevant QueryInstances
+    """
+    query_dict = {}
+    offsets = data.query_offsets
+
+    for k in range(len(offsets) - 1):
+        start, end = offsets[k], offsets[k + 1]
+        qid = int(data.qids[start])
+        features = data.features[start:end].tolist()
+        ratings = data.ratings[start:end].tolist()
+        query_dict[qid] = [QueryInstance(qid, ratings[i], features[i]) for i in range(end - start)]
+
+    return query_dict
+
+
+def query_groups_from_letor(data):
+    """The per-query (features matrix, ratings array) groups of group_features_by_query, as views into columnar data.
+
+    :param data: A LetorData
+    :return: A list with a (features matrix, ratings array) tuple per query
+    """
+    offsets = data.query_offsets
+
+    return [(data.features[offsets[k]:offsets[k + 1]], data.ratings[offsets[k]:offsets[k + 1]])
+            for k in range(len(offsets) - 1)]
+
+
+def load_query_dict(file_path, use_cache=False):
+    """The query dict of load_query_dict_from_file, optionally parsed through load_letor_arrays and its binary cache.
+    The cache stores the features as float32, so with it the feature values are rounded to about 7 significant
+    digits (e.g. 0.007477 becomes 0.007476999890059233); without it this is load_query_dict_from_file.
+
+    :param file_path: A file with the data.
+    :param use_cache: Whether to read and write the binary cache (next to the data file, see letor_cache_dir).
+    :return: A dict mapping query IDs to relevant QueryInstances
+    """
+    if not use_cache:
+        return load_query_dict_from_file(file_path)
+
+    return query_dict_from_letor(load_letor_arrays(file_path))
+
+
+def iter_queries_from_file(file_path):
+    """Reads a file lazily and yields the QueryInstances of one query at a time. Assumes that the lines of each
+    query ID are consecutive, as they are in LETOR files, so only one query is held in memory.
+
+    :param file_path: A file with the data.
+    :return: A generator of lists of QueryInstances sharing a query ID
+    """
+    with open(file_path) as queries_file:
+        query_instances = []
+        for line in queries_file:
+            if not line.strip():
+                continue
+
+            q_inst = parse_query_instance(line)
+            if query_instances and q_inst.qid != query_instances[0].qid:
+                yield query_instances
+                query_instances = []
+            query_instances.append(q_inst)
+
+        if query_instances:
+            yield query_instances
+
+
+def iter_query_pairs(query_instances):
+    """Yields every feature pair of a single query where the first item has a higher rating than the second.
+
+    :param query_instances: All QueryInstances of one query ID
+    :return: A generator of (higher rated features, lower rated features) tuples
+    """
+    # Split the examples by rating
+    instances_split_by_rating = dict()
+    for instance in query_instances:
+        key = instance.rating
+        if key in instances_split_by_rating:
+            instances_split_by_rating[key].append(instance)
+        else:
+            instances_split_by_rating[key] = [instance]
+
+    # Find all rating values and sort them in descending orders
+    rating_values = sorted(instances_split_by_rating.keys(), reverse=True)
+
+    # Generate every possible pair
+    for i in range(len(rating_values) - 1):
+        for j in range(i + 1, len(rating_values)):
+            for higher_ranked_item in instances_split_by_rating[rating_values[i]]:
+                for lower_ranked_item in instances_split_by_rating[rating_values[j]]:
+                    yield higher_ranked_item.features, lower_ranked_item.features
+
+
+def iter_sorted_feature_pairs(query_dict):
+    """The streaming form of generate_sorted_feature_pairs: yields the same pairs in the same order, query by query.
+
+    :param query_dict: A dictionary mapping query_id to a list of relevant QueryInstances
+    :return: A generator of feature pairs
+    """
+    for query_id in query_dict:
+        # This iterates through every query ID in our training set
+        for pair in iter_query_pairs(query_dict[query_id]):
+            yield pair
+
+
 def generate_sorted_feature_pairs(query_dict):
     """Finds all possible QueryInstance pairs for all queries in a query dictionary. It strips the pairs of anything
     but their features. The pairs will be for the same query ID, and the first will have a higher rating than the
@@ -58,32 +403,87 @@ def generate_sorted_feature_pairs(query_dict):
     :param query_dict: A dictionary mapping query_id to a list of relevant QueryInstances
     :return: All possible feature pairs given the query
     """
-    results = list()
+    return list(iter_sorted_feature_pairs(query_dict))
+
+
+def shuffle_buffer(items, buffer_size, rng=random):
+    """Shuffles a stream approximately, holding at most buffer_size items in memory. Each incoming item replaces a
+    randomly chosen buffered item, which is yielded. A buffer at least as large as the stream gives a full shuffle.
+
+    :param items: An iterable
+    :param buffer_size: Maximum number of buffered items
+    :param rng: Source of randomness (the random module or a random.Random)
+    :return: A generator of the items in shuffled order
+    """
+    buffer = []
+
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+
+        index = rng.randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = item
+
+    rng.shuffle(buffer)
+    for item in buffer:
+        yield item
+
+
+class PairStream:
+    """
+    A re-iterable stream of feature pairs read lazily from a data file. Every iteration re-reads the file query by
+    query and passes the pairs through a shuffle buffer, so memory stays bounded by one query plus the buffer no
+    matter how large the file is. It can be passed wherever a list of pairs is used, e.g. to NN.train.
+    """
+
+    def __init__(self, file_path, buffer_size=10000, seed=None):
+        """
+        :param file_path: A file with the data.
+        :param buffer_size: Size of the shuffle buffer. 0 keeps the file order.
+        :param seed: Seed for the shuffling. Each iteration continues the same random sequence.
+        """
+        self.file_path = file_path
+        self.buffer_size = buffer_size
+        self.rng = random.Random(seed)
+
+    def __iter__(self):
+        pairs = (pair for query_instances in iter_queries_from_file(self.file_path)
+                 for pair in iter_query_pairs(query_instances))
+
+        if self.buffer_size > 0:
+            pairs = shuffle_buffer(pairs, self.buffer_size, self.rng)
+
+        return iter(pairs)
+
+
+def group_features_by_query(query_dict):
+    """Collects the features and ratings of each query into arrays, for training without materializing the pairs
+    (see VectorizedNN.train_factorized). Memory grows with the number of documents rather than the number of pairs.
+
+    :param query_dict: A dictionary mapping query_id to a list of relevant QueryInstances
+    :return: A list with a (features matrix, ratings array) tuple per query
+    """
+    groups = list()
 
     for query_id in query_dict:
-        # This iterates through every query ID in our training set
-        query_instances = query_dict[query_id]  # All query instances for the query_id
+        query_instances = query_dict[query_id]
+        features = np.array([instance.features for instance in query_instances], dtype=np.float64)
+        ratings = np.array([instance.rating for instance in query_instances])
+        groups.append((features, ratings))
 
-        # Split the examples by rating
-        instances_split_by_rating = dict()
-        for instance in query_instances:
-            key = instance.rating
-            if key in instances_split_by_rating:
-                instances_split_by_rating[key].append(instance)
-            else:
-                instances_split_by_rating[key] = [instance]
+    return groups
 
-        # Find all rating values and sort them in descending orders
-        rating_values = sorted(instances_split_by_rating.keys(), reverse=True)
 
-        # Generate every possible pair
-        for i in range(len(rating_values) - 1):
-            for j in range(i + 1, len(rating_values)):
-                for higher_ranked_item in instances_split_by_rating[rating_values[i]]:
-                    for lower_ranked_item in instances_split_by_rating[rating_values[j]]:
-                        results.append((higher_ranked_item.features, lower_ranked_item.features))
+def rank_queries(nn, query_dict):
+    """Ranks the instances of every query with a network, one vectorized call per query.
 
-    return results
+    :param nn: A trained NN or VectorizedNN (ideally a frozen one, see VectorizedNN.freeze)
+    :param query_dict: A dictionary mapping query_id to a list of relevant QueryInstances
+    :return: A dictionary mapping query_id to its QueryInstances, best first
+    """
+    return {query_id: nn.rank(query_dict[query_id]) for query_id in query_dict}
 
 
 def average_lists(list_of_lists, invert=False):
@@ -128,7 +528,22 @@ def plot_errors(*args):
     plt.show()
 
 
-def run_ranknet(training_set, test_set, learning_rate=0.001, epochs=25):
+def load_columns(file_path, use_cache=True):
+    """Loads a data file in columnar form: memory-mapped from the binary cache, or parsed directly without a cache.
+
+    :param file_path: A file with the data.
+    :param use_cache: Whether to go through the binary cache.
+    :return: A LetorData
+    """
+    if use_cache:
+        return open_feature_store(file_path)
+
+    return parse_letor_file(file_path)
+
+
+def run_ranknet(training_set, test_set, learning_rate=0.001, epochs=25, mode='scalar', batch_size=32, stream=False,
+                shuffle_buffer_size=10000, use_cache=None, seed=None, verbose=True, num_hidden=10, stop_early=None,
+                evaluation='pairs', sample_size=1000, return_intervals=False, tie_weight=0.0):
     """Runs the the RankNet algorithm for the given number of epochs and returns a tuple of training set error rates
     and test set error rates, listed for each epoch.
 
@@ -136,74 +551,201 @@ def run_ranknet(training_set, test_set, learning_rate=0.001, epochs=25):
     :param test_set: File path to test set
     :param learning_rate: Learning rate of the neural network
     :param epochs: Number of epochs that the set will be run for
-    :return: Training set error rates, test set error rates
+    :param mode: 'scalar' for the list-based NN, 'vectorized' for the NumPy-backed VectorizedNN, 'factorized' for
+        VectorizedNN trained per query without materializing the pairs
+    :param batch_size: Pairs per weight update in vectorized mode
+    :param stream: Read the pairs lazily from the files on every epoch instead of loading them (see PairStream).
+        Not available in factorized mode.
+    :param shuffle_buffer_size: Size of the shuffle buffer for streamed training pairs
+    :param use_cache: Load the files through the binary cache of load_letor_arrays (memory-mapped in the vectorized
+        and factorized modes, which use float32 features either way). Defaults to True in those modes and to False in
+        scalar mode, which then reads the files with load_query_dict_from_file and keeps the features exact.
+    :param seed: Seed for the weight initialization and the shuffling, for reproducible runs
+    :param verbose: Whether to print progress
+    :param num_hidden: Number of hidden nodes
+    :param stop_early: Optional function called after each epoch as stop_early(epoch, training_errors, testing_errors).
+        Training stops when it returns True, so the returned lists can be shorter than epochs + 1.
+    :param evaluation: How the error ratios are found in the scalar and vectorized modes: 'pairs', 'documents' or
+        'sample' (see NN.count_misordered_pairs). With 'sample', one sample of the training pairs and one of the test
+        pairs are drawn at the start of the run (seeded by seed) and every epoch is evaluated on the same samples.
+    :param sample_size: Number of pairs per sample for evaluation='sample'
+    :param return_intervals: Whether to also return the 95% Wilson confidence intervals of the error rates, as lists
+        of (low, high). They only have a width with evaluation='sample'; exact error rates get (rate, rate).
+    :param tie_weight: How much pairs whose documents get the same score count as misordered (see
+        Backprop_skeleton.count_misordered). Use 0.5 or 1 to compare runs, so a network whose scores collapsed to a
+        constant does not look perfect.
+    :return: Training set error rates, test set error rates (and their confidence intervals)
     """
 
-    query_dict_training = load_query_dict_from_file(training_set)
-    query_dict_testing = load_query_dict_from_file(test_set)
-
-    nn = bp.NN(46, 10, learning_rate)  # Create an artificial neural network
-
-    training_pairs = generate_sorted_feature_pairs(query_dict_training)
-    testing_pairs = generate_sorted_feature_pairs(query_dict_testing)
+    log = print if verbose else lambda *args: None
+
+    if use_cache is None:
+        use_cache = mode != 'scalar'
+
+    if seed is not None:
+        random.seed(seed)
+
+    if mode == 'scalar':
+        nn = bp.NN(46, num_hidden, learning_rate)  # Create an artificial neural network
+        train = functools.partial(nn.train, evaluation=evaluation, tie_weight=tie_weight)
+        evaluate = functools.partial(nn.count_misordered_pairs, evaluation=evaluation, tie_weight=tie_weight)
+    elif mode == 'vectorized':
+        nn = bp.VectorizedNN(46, num_hidden, learning_rate)
+        train = functools.partial(nn.train, batch_size=batch_size, evaluation=evaluation, tie_weight=tie_weight)
+        evaluate = functools.partial(nn.count_misordered_pairs, evaluation=evaluation, tie_weight=tie_weight)
+    elif mode == 'factorized':
+        nn = bp.VectorizedNN(46, num_hidden, learning_rate)
+        train = functools.partial(nn.train_factorized, tie_weight=tie_weight)
+        evaluate = functools.partial(nn.count_misordered_pairs_by_query, tie_weight=tie_weight)
+    else:
+        raise ValueError('Unknown mode: ' + str(mode))
+
+    if stream:
+        if mode == 'factorized':
+            raise ValueError('Streaming is not available in factorized mode')
+
+        training_data = PairStream(training_set, shuffle_buffer_size, seed)
+        testing_data = PairStream(test_set, buffer_size=0)
+        training_set_size = testing_set_size = 'streamed'
+    elif mode == 'factorized':
+        # Keep the documents grouped by query; the pairs are never materialized
+        training_data = query_groups_from_letor(load_columns(training_set, use_cache))
+        testing_data = query_groups_from_letor(load_columns(test_set, use_cache))
+        training_set_size = bp.count_pairs_by_query(training_data)
+        testing_set_size = bp.count_pairs_by_query(testing_data)
+    elif mode == 'vectorized':
+        # Pairs as row numbers into the (memory-mapped) feature matrices
+        training_data = generate_sorted_index_pairs(load_columns(training_set, use_cache))
+        testing_data = generate_sorted_index_pairs(load_columns(test_set, use_cache))
+        training_set_size = len(training_data.higher)
+        testing_set_size = len(testing_data.higher)
+    else:
+        training_data = generate_sorted_feature_pairs(load_query_dict(training_set, use_cache))
+        testing_data = generate_sorted_feature_pairs(load_query_dict(test_set, use_cache))
+        training_set_size = len(training_data)
+        testing_set_size = len(testing_data)
+
+    if evaluation == 'sample' and mode != 'factorized':
+        # Draw the samples once, so that the error rates of all epochs are measured on the same pairs
+        sample_rng = random.Random(seed)
+        training_evaluation_data = bp.sample_pairs(training_data, sample_size, sample_rng)
+        testing_evaluation_data = bp.sample_pairs(testing_data, sample_size, sample_rng)
+        train = functools.partial(train, evaluation='documents', evaluation_patterns=training_evaluation_data)
+        evaluate = functools.partial(evaluate, evaluation='documents')
+        training_sample_size = len(getattr(training_evaluation_data, 'higher', training_evaluation_data))
+        testing_sample_size = len(getattr(testing_evaluation_data, 'higher', testing_evaluation_data))
+    else:
+        training_evaluation_data, testing_evaluation_data = training_data, testing_data
+        training_sample_size = testing_sample_size = None
+
+    def interval(error_rate, size):
+        if size is None:
+            return error_rate, error_rate
+        return bp.wilson_interval(round(error_rate * size), size)
 
     # Check ANN performance before training
-    print("\nTraining neural network")
-    print("\n\tLearning rate:", learning_rate)
-    print("\tIterations:", epochs)
-    print("\n\tTraining set size:", len(training_pairs))
-    print("\tTest set size:", len(testing_pairs))
+    log("\nTraining neural network")
+    log("\n\tLearning rate:", learning_rate)
+    log("\tIterations:", epochs)
+    log("\tMode:", mode)
+    log("\n\tTraining set size:", training_set_size)
+    log("\tTest set size:", testing_set_size)
 
     a = time.time()  # For measuring time taken
 
     # Check performance before training
-    performance_on_training_pairs_before_training = nn.count_misordered_pairs(training_pairs)
-    performance_on_testing_pairs_before_training = nn.count_misordered_pairs(testing_pairs)
+    performance_on_training_pairs_before_training = evaluate(training_evaluation_data)
+    performance_on_testing_pairs_before_training = evaluate(testing_evaluation_data)
 
-    print("\nPerformance on test set before training:", performance_on_testing_pairs_before_training)
+    log("\nPerformance on test set before training:", performance_on_testing_pairs_before_training)
 
     training_errors = [performance_on_training_pairs_before_training]
     testing_errors = [performance_on_testing_pairs_before_training]
+    training_intervals = [interval(training_errors[0], training_sample_size)]
+    testing_intervals = [interval(testing_errors[0], testing_sample_size)]
 
     for i in range(epochs):
-        training_errors.append(nn.train(training_pairs, iterations=1)[0])
-        testing_errors.append(nn.count_misordered_pairs(testing_pairs))  # Check ANN performance after training.
+        training_errors.append(train(training_data, iterations=1)[0])
+        testing_errors.append(evaluate(testing_evaluation_data))  # Check ANN performance after training.
+        training_intervals.append(interval(training_errors[-1], training_sample_size))
+        testing_intervals.append(interval(testing_errors[-1], testing_sample_size))
+
+        log('\nTraining error epoch %d:' % (i + 1), training_errors[-1])
+        log('Testing error epoch %d:' % (i + 1), testing_errors[-1])
+        if testing_sample_size is not None:
+            log('95%% confidence interval of the testing error: %.4f - %.4f' % testing_intervals[-1])
 
-        print('\nTraining error epoch %d:' % (i + 1), training_errors[i])
-        print('Testing error epoch %d:' % (i + 1), testing_errors[i])
+        if stop_early is not None and stop_early(i + 1, training_errors, testing_errors):
+            log('\nStopping early after epoch %d' % (i + 1))
+            break
 
     b = time.time()
 
-    print('\nFinished training and testing in %.2f minutes.' % ((b - a) / 60))
+    log('\nFinished training and testing in %.2f minutes.' % ((b - a) / 60))
 
+    if return_intervals:
+        return training_errors, testing_errors, training_intervals, testing_intervals
     return training_errors, testing_errors
 
 
-def average_run_ranknet(training_set, test_set, learning_rate=0.001, epochs=25, runs=5):
+def average_run_ranknet(training_set, test_set, learning_rate=0.001, epochs=25, runs=5, mode='scalar', workers=1,
+                        seeds=None, plot=True):
     """
     Does a few runs of the run_ranknet algorithm with the same parameters and averages the results.
 
+    The runs share no state, so with workers > 1 they run concurrently in a process pool. The data files are parsed
+    once into the binary cache up front, and every worker then reads (or memory-maps) the cached arrays. Given the
+    same seeds, the averages are the same as in a serial run.
+
     :param training_set:
     :param test_set:
     :param learning_rate:
     :param epochs:
     :param runs:
-    :return:
+    :param mode: Network mode, see run_ranknet
+    :param workers: Number of processes to run the runs in. 1 runs them one after another in this process.
+    :param seeds: One seed per run. Drawn from the random module if not given.
+    :param plot: Whether to plot the averages
+    :return: Average training and testing ratios of correctly ordered pairs, by epoch
     """
 
+    if seeds is None:
+        seeds = [random.randrange(2 ** 32) for _ in range(runs)]
+    elif len(seeds) != runs:
+        raise ValueError('Expected one seed per run')
+
     training_error_rates = list()
     testing_error_rates = list()
 
-    for i in range(runs):
-        print("\nRun %d of %d" % (i + 1, runs))
-        x, y = run_ranknet(training_set, test_set, learning_rate, epochs)
+    if workers > 1:
+        if mode != 'scalar':
+            # Parse once here; the workers load the cached arrays instead of the text files
+            load_letor_arrays(training_set)
+            load_letor_arrays(test_set)
+
+        print("\nRunning %d runs on %d workers" % (runs, workers))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_ranknet, training_set, test_set, learning_rate, epochs, mode=mode,
+                                       seed=seeds[i], verbose=False)
+                       for i in range(runs)]
+            results = [future.result() for future in futures]
+    else:
+        results = list()
+        for i in range(runs):
+            print("\nRun %d of %d" % (i + 1, runs))
+            results.append(run_ranknet(training_set, test_set, learning_rate, epochs, mode=mode, seed=seeds[i]))
+
+    for x, y in results:
         training_error_rates.append(x)
         testing_error_rates.append(y)
 
     average_training_error_rates = average_lists(training_error_rates, invert=True)
     average_testing_error_rates = average_lists(testing_error_rates, invert=True)
 
-    plot_errors(average_training_error_rates, average_testing_error_rates)
+    if plot:
+        plot_errors(average_training_error_rates, average_testing_error_rates)
+
+    return average_training_error_rates, average_testing_error_rates
 
 
 if __name__ == '__main__':
@@ -0,0 +1,211 @@
+"""
+Hyperparameter sweeps for the RankNet in data_loader_skeleton.run_ranknet.
+
+A sweep is a list of trials, each a dict of run_ranknet arguments (e.g. learning_rate, num_hidden, epochs), made by
+grid_search_space or random_search_space. run_sweep runs the trials in a process pool, stops hopeless trials early
+from their per-epoch test error, and returns a leaderboard that write_leaderboard saves as CSV or JSON.
+
+Trials are ranked by an error ratio that counts pairs with equal scores as half misordered (tie_weight=0.5), so a
+network whose scores have saturated to one value gets 0.5, like chance, instead of a perfect 0.
+
+Run from the ex05 directory: python ranknet_sweep.py
+"""
+
+import concurrent.futures
+import csv
+import itertools
+import json
+import math
+import random
+import time
+
+import data_loader_skeleton as dl
+
+
+def grid_search_space(space):
+    """Makes one trial for every combination of values.
+
+    :param space: A dict mapping run_ranknet argument names to lists of values
+    :return: A list of trials (dicts of arguments)
+    """
+    names = sorted(space)
+
+    return [dict(zip(names, values)) for values in itertools.product(*[space[name] for name in names])]
+
+
+def random_search_space(space, trials, seed=None):
+    """Draws trials at random. A list of values is sampled uniformly, and a function is called with a random.Random
+    to draw a value, e.g. lambda rng: 10 ** rng.uniform(-4, -1) for a log-uniform learning rate.
+
+    :param space: A dict mapping run_ranknet argument names to lists of values or to functions
+    :param trials: Number of trials
+    :param seed: Seed for the sampling
+    :return: A list of trials (dicts of arguments)
+    """
+    rng = random.Random(seed)
+    names = sorted(space)
+    results = []
+
+    for _ in range(trials):
+        trial = {}
+        for name in names:
+            values = space[name]
+            trial[name] = values(rng) if callable(values) else rng.choice(values)
+        results.append(trial)
+
+    return results
+
+
+class EarlyStopping:
+    """
+    Stopping rule for run_ranknet's stop_early argument, based on the test error after each epoch.
+
+    After grace_epochs, a trial stops if its test error is still at or above max_error (it is not learning to rank
+    better than chance, or its scores have collapsed, when ties count as half misordered), or if its best test error
+    has not improved by at least min_delta in the last patience epochs.
+    """
+
+    def __init__(self, patience=3, min_delta=0.0, grace_epochs=2, max_error=0.5):
+        """
+        :param patience: Epochs without improvement before stopping
+        :param min_delta: Smallest decrease of the test error that counts as an improvement
+        :param grace_epochs: Epochs before the rule is applied
+        :param max_error: Test error that marks a trial as hopeless after the grace epochs
+        """
+        self.patience = patience
+        self.min_delta = min_delta
+        self.grace_epochs = grace_epochs
+        self.max_error = max_error
+
+    def __call__(self, epoch, training_errors, testing_errors):
+        if epoch < self.grace_epochs:
+            return False
+
+        if testing_errors[-1] >= self.max_error:
+            return True
+
+        best_error, best_epoch = testing_errors[0], 0  # testing_errors[i] is the error after epoch i
+        for i in range(1, len(testing_errors)):
+            if testing_errors[i] < best_error - self.min_delta:
+                best_error, best_epoch = testing_errors[i], i
+
+        return epoch - best_epoch >= self.patience
+
+
+def run_trial(training_set, test_set, trial, mode='vectorized', seed=None, early_stopping=None, tie_weight=0.5):
+    """Runs one trial and summarizes it.
+
+    :param training_set: File path to training set
+    :param test_set: File path to test set
+    :param trial: A dict of run_ranknet arguments
+    :param mode: Network mode, see run_ranknet
+    :param seed: Seed for the run
+    :param early_stopping: Stopping rule (e.g. an EarlyStopping), or None to run all epochs
+    :param tie_weight: How much pairs with equal scores count as misordered (see run_ranknet)
+    :return: A dict with the trial's arguments and results
+    """
+    start = time.perf_counter()
+    training_errors, testing_errors = dl.run_ranknet(training_set, test_set, mode=mode, seed=seed, verbose=False,
+                                                     stop_early=early_stopping, tie_weight=tie_weight, **trial)
+    seconds = time.perf_counter() - start
+
+    best_epoch = min(range(len(testing_errors)), key=lambda i: testing_errors[i])
+    epochs_run = len(testing_errors) - 1
+
+    result = dict(trial)
+    result.update({
+        'seed': seed,
+        'best_test_error': float(testing_errors[best_epoch]),
+        'best_epoch': best_epoch,
+        'final_training_error': float(training_errors[-1]),
+        'final_test_error': float(testing_errors[-1]),
+        'epochs_run': epochs_run,
+        'stopped_early': epochs_run < trial.get('epochs', 25),
+        'seconds': round(seconds, 3),
+    })
+
+    return result
+
+
+def run_sweep(training_set, test_set, trials, mode='vectorized', workers=1, seed=None, early_stopping=None,
+              tie_weight=0.5):
+    """Runs a list of trials, concurrently when workers > 1, and ranks them by their best test error.
+
+    :param training_set: File path to training set
+    :param test_set: File path to test set
+    :param trials: A list of dicts of run_ranknet arguments, e.g. from grid_search_space
+    :param mode: Network mode, see run_ranknet
+    :param workers: Number of processes
+    :param seed: Seed from which every trial gets its own seed
+    :param early_stopping: Stopping rule (e.g. an EarlyStopping), or None to run all epochs
+    :param tie_weight: How much pairs with equal scores count as misordered. The default 0.5 keeps trials whose
+        scores collapsed from ranking first.
+    :return: The leaderboard: a list of result dicts, best first
+    """
+    rng = random.Random(seed)
+    seeds = [rng.randrange(2 ** 32) for _ in trials]
+
+    if mode != 'scalar':
+        # Parse once here; the trials load the cached arrays instead of the text files (scalar runs read them exactly)
+        dl.load_letor_arrays(training_set)
+        dl.load_letor_arrays(test_set)
+
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_trial, training_set, test_set, trials[i], mode, seeds[i], early_stopping,
+                                       tie_weight)
+                       for i in range(len(trials))]
+            results = [future.result() for future in futures]
+    else:
+        results = [run_trial(training_set, test_set, trials[i], mode, seeds[i], early_stopping, tie_weight)
+                   for i in range(len(trials))]
+
+    return sorted(results, key=lambda result: result['best_test_error'])
+
+
+def write_leaderboard(results, file_path):
+    """Writes a leaderboard as JSON if the file name ends in .json, and as CSV otherwise.
+
+    :param results: A list of result dicts from run_sweep
+    :param file_path: The output file
+    """
+    with open(file_path, 'w', newline='') as f:
+        if file_path.endswith('.json'):
+            json.dump(results, f, indent=2)
+            return
+
+        field_names = []
+        for result in results:
+            field_names.extend(name for name in result if name not in field_names)
+
+        writer = csv.DictWriter(f, fieldnames=field_names)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def print_leaderboard(results, top=10):
+    """Prints the best trials of a leaderboard.
+
+    :param results: A list of result dicts from run_sweep
+    :param top: Number of trials to print
+    """
+    print("\n%-4s %-12s %-8s %-8s %-10s %-8s %s" % ('Rank', 'Learn rate', 'Hidden', 'Epochs', 'Best test', 'Stopped',
+                                                     'Seconds'))
+    for rank, result in enumerate(results[:top]):
+        print("%-4d %-12.3g %-8s %-8s %-10.4f %-8s %.1f" % (rank + 1, result.get('learning_rate', float('nan')),
+                                                            result.get('num_hidden', ''), result['epochs_run'],
+                                                            result['best_test_error'], result['stopped_early'],
+                                                            result['seconds']))
+
+
+if __name__ == '__main__':
+    search_space = {
+        'learning_rate': lambda rng: 10 ** rng.uniform(-4, math.log10(0.5)),
+        'num_hidden': [5, 10, 20, 40],
+        'epochs': [25],
+    }
+
+    leaderboard = run_sweep("data_sets/train.txt", "data_sets/test.txt", random_search_space(search_space, 20, seed=0),
+                            workers=4, seed=0, early_stopping=EarlyStopping())
+    print_leaderboard(leaderboard)
+    write_leaderboard(leaderboard, "ranknet_sweep.csv")